@@ -22,6 +22,7 @@ import os
 
 # Internal imports
 from pywisp.aircontrol import ACDevice, int2ip, is_ip
+from pywisp.match import parse_ip_range
 from pywisp.mikrotik import MTDevice
 from pywisp.sshdevice import backup_devices
 
@@ -78,18 +79,15 @@ class MyWISP():
         print("CCR: {ccr} (VACCs): {count} VACCs".format(
             ccr=str(ccr), count=str(len(antenas))))
 
-        # Get RTs from all CCRs, ans save CCRs list
-        ccrs = []
-        for ccr_ip in self.get_ccrs_ips():
-            antenas_ccr, ccr = self.get_dhcp_clients_from_ccr_ip(
-                ccr_ip, password_ccr=PASSWORD, password_devices=PASSWORD, find=".*-RT")
-            print("CCR: {ccr}: {count} RTs".format(
-                ccr=str(ccr), count=len(antenas_ccr)))
+        # Get RTs from all CCRs concurrently, ans save CCRs list
+        ccrs = self.get_ccrs()
+        leases = self.harvest_dhcp_leases(ccrs, name=".*-RT")
+        print("CCRs: {count} RTs".format(count=len(leases)))
 
-            if len(antenas_ccr) > 0:
-                antenas += antenas_ccr
-
-            ccrs.append(ccr)
+        antenas += [
+            MTDevice(lease, username='admin', password=PASSWORD, rsa=ID_RSA)
+            for lease in leases.leases
+        ]
 
         # Add CCRs
         antenas += ccrs
@@ -123,7 +121,9 @@ class MyWISP():
             return self.get_rts(name, self.get_ccrs())
 
         # Get devices list
-        if not deep:
+        if not deep and parse_ip_range(name):
+            clients = self.ac.getDevices(ip=name)
+        elif not deep:
             clients = self.ac.getDevices(name=name)
         else:
             clients = self.get_aircontrol_deep(name, from_br)
@@ -194,13 +194,11 @@ class MyWISP():
         ]
 
     def get_rts(self, name, ccrs):
-        '''Get RTs from all CCRs, ans save CCRs list'''
-        devices = []
-        for ccr in ccrs:
-            devices_ccr = self.get_dhcp_clients_from_ccr(
-                ccr, password_ccr=PASSWORD, password_devices=PASSWORD, find=".*{}-RT".format(name[:-3]))
-
-            if len(devices_ccr) > 0:
-                devices += devices_ccr
+        '''Get RTs from all CCRs concurrently'''
+        leases = self.harvest_dhcp_leases(
+            ccrs, name=".*{}-RT".format(name[:-3]))
 
-        return devices
+        return [
+            MTDevice(lease, username='admin', password=PASSWORD, rsa=ID_RSA)
+            for lease in leases.leases
+        ]
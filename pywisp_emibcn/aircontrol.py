@@ -5,8 +5,19 @@ import os
 import requests
 import ipaddress
 import datetime
+import io
 import json
+import time
+import hashlib
+import tarfile
 from pywisp_emibcn.sshdevice import SSHDevice
+from pywisp_emibcn.records import DeviceRecord
+from pywisp_emibcn.index import IPIndex
+from pywisp_emibcn.topology import Topology
+from pywisp_emibcn.match import parse_ip_range
+from pywisp_emibcn.jsonstream import iter_json_array
+from pywisp_emibcn.parallel import parallel_map, default_scheduler
+from pywisp_emibcn.profiling import profiler
 
 from pprint import pformat
 
@@ -52,16 +63,39 @@ class ACDevice(SSHDevice):
     '''AirControl/Ubiquiti device class'''
 
     id = 0
+    controller = None
     ssid = ""
     branch = ""
     product = ""
-    data = {}
+    record = None
+    _data = None
+    backup_format = 'tar'
+
+    # Clients location index (a `LocationIndex`), filled with every station table
+    location_index = None
 
     def __init__(self, json, ac=None, *args, **kwargs):
         '''Set specific AirOS values'''
 
         today = datetime.date.today()
 
+        # Compact record: its full JSON will be loaded only if needed
+        if isinstance(json, DeviceRecord):
+            self.record = json
+            self.id = json.id
+            self.controller = json.controller
+            kwargs['name'] = json.name
+            kwargs['mac'] = json.mac_address
+            kwargs['ip'] = json.ip_address
+            kwargs['status'] = json.status
+            if json.parent is not None:
+                self.branch = json.parent
+            self.ssid = json.ssid
+            self.product = json.product
+
+            super().__init__(*args, **kwargs)
+            return
+
         if ac and 'hostname' in json['properties']:
             d = ac.getDevices(name=json['properties']['hostname'])
             if len(d) > 0:
@@ -73,6 +107,7 @@ class ACDevice(SSHDevice):
 
         # Assign data from original device JSON
         self.id = json['deviceId']
+        self.controller = json.get('controller')
 
         if 'hostname' in json['properties']:
             kwargs['name'] = json['properties']['hostname']
@@ -96,6 +131,23 @@ class ACDevice(SSHDevice):
 
         super().__init__(*args, **kwargs)
 
+    @property
+    def key(self):
+        '''Key of the device in its AirControl inventory (see `ACSession.deviceKey`)'''
+        if self.controller is not None:
+            return self.controller, self.id
+        return self.id
+
+    @property
+    def data(self):
+        if self._data is None and self.record is not None:
+            return self.record.data
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+
     def getName(self):
         '''Get device name from the device itself'''
 
@@ -110,21 +162,59 @@ class ACDevice(SSHDevice):
         super().setBackupName(backup_file=backup_file)
         self.backup_file += ".tar"
 
-    def backup(self, path):
+    # Files saved on backups
+    backup_files = ["/tmp/system.cfg", "/etc/persistent/rc.prestart",
+                    "/etc/persistent/rc.poststart"]
+
+    def getBackup(self):
+        '''Get a tar with the device config files'''
 
-        self.login()
+        # Newer AirOS firmwares have SFTP or SCP: build the tar locally
+        if self.getTransferMethod() != 'exec':
+            return self.tarFiles(self.getFiles(self.backup_files))
 
-        # No sFTP server on Ubiquiti systems. Let's do a tar.
-        # Send tar command with stdout as local backup file
-        files = ["/tmp/system.cfg", "/etc/persistent/rc.prestart",
-                 "/etc/persistent/rc.poststart"]
+        # No sFTP server on old Ubiquiti systems. Let's do a tar.
+        # Send tar command and return its stdout as backup file
         command = 'tar -c -f - {}'.format(" ".join('"{}"'.format(f)
-                                          for f in files))
+                                          for f in self.backup_files))
         stdin, stdout, stderr = self.command(command)
 
-        # Write tar command output to local tar file
-        with open(path + '/' + self.backup_file, "wb") as myfile:
-            myfile.write(stdout.read())
+        with profiler.phase('read', self.ip):
+            return stdout.read()
+
+    @staticmethod
+    def tarFiles(files):
+        '''Pack {path: contents} into a tar, with the same names the device's tar uses'''
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode='w') as tar:
+            for path, data in files.items():
+                info = tarfile.TarInfo(path.lstrip('/'))
+                info.size = len(data)
+                info.mode = 0o644
+                info.mtime = time.time()
+                tar.addfile(info, io.BytesIO(data))
+
+        return buffer.getvalue()
+
+    def getFingerprint(self):
+        '''Checksum config files on the device itself'''
+
+        command = 'md5sum {}'.format(" ".join('"{}"'.format(f)
+                                     for f in self.backup_files))
+        stdin, stdout, stderr = self.command(command)
+        checksums = stdout.read()
+
+        if not checksums.strip():
+            return None
+
+        return hashlib.sha1(checksums).hexdigest()
+
+    def getChecksum(self, path):
+        '''MD5 of a remote file, computed on the device'''
+        stdin, stdout, stderr = self.command('md5sum "{}"'.format(path))
+        output = stdout.read().decode().split()
+
+        return output[0] if output else None
 
     def getWifiStatus(self):
         status = {}
@@ -141,11 +231,25 @@ class ACDevice(SSHDevice):
 
         return status
 
+    def getTargets(self):
+        '''SSH sessions to a device load its BR, too'''
+        targets = super().getTargets()
+        if self.branch:
+            targets.append("br:{}".format(self.branch))
+        return targets
+
     def getWifiStations(self):
         command = "wstalist ath0"
         stdin, stdout, stderr = self.command(command)
 
-        return json.loads(stdout.read().decode())
+        with profiler.phase('read', self.ip):
+            stations = stdout.read()
+        with profiler.phase('parse', self.ip):
+            stations = json.loads(stations.decode())
+        if self.location_index is not None:
+            self.location_index.update(self, stations)
+
+        return stations
 
     def __str__(self):
         return u"{} : {} - {} ({})".format(self.name, self.mac, self.ip, self.id)
@@ -158,6 +262,23 @@ class ACSession():
     username = ""
     password = ""
     devices = None
+    ip_index = None
+    topology = None
+
+    # Inventory validators and content hashes, for cheap refreshes
+    etag = None
+    last_modified = None
+    hashes = None
+
+    # Limits for concurrent requests to this server
+    scheduler = default_scheduler
+
+    # Parse the inventory while downloading it, keeping only these properties
+    # (or properties starting with them): full data is then asked by device
+    stream = False
+    stream_properties = ('hostname', 'mac', 'ip', 'status', 'essid', 'product',
+                         'wlanOpModeString', 'chain', 'channel', 'freq', 'noise',
+                         'distance', 'signal')
 
     def __init__(self, URL, username, password):
         '''Assign login parameters'''
@@ -191,7 +312,7 @@ class ACSession():
         # Save cookies (session)
         self.cookies = resp.cookies
 
-    def sendRequest(self, path, method="get", body=None):
+    def sendRequest(self, path, method="get", body=None, stream=False, headers=None):
         '''Send request to AirControl API server using cookies from login'''
         if body is None:
             body = {}
@@ -200,33 +321,73 @@ class ACSession():
             'cookies': self.cookies,
             'headers': {
                 'Accept': 'application/json',
-                'Content-Type': 'application/json'
+                'Content-Type': 'application/json',
+                **(headers or {})
             },
             'verify': False,
         }
 
-        if method == 'get':
-            resp = requests.get(URL, **arguments)
-        elif method == 'post':
-            resp = requests.post(URL, data=str(body), **arguments)
-        elif method == 'patch':
-            resp = requests.patch(URL, data=str(body), **arguments)
+        with self.slot(), profiler.phase('http'):
+            if method == 'get':
+                resp = requests.get(URL, stream=stream, **arguments)
+            elif method == 'post':
+                resp = requests.post(URL, data=str(body), **arguments)
+            elif method == 'patch':
+                resp = requests.patch(URL, data=str(body), **arguments)
 
-        # This means something went wrong.
-        if resp.status_code > 299:
+        # This means something went wrong (304 answers conditional requests)
+        if resp.status_code > 299 and resp.status_code != 304:
             raise Exception(u'{} {} {}: {} ({})'.format(
                 method.upper(), path, resp.status_code, resp.text, pformat(body)))
 
         return resp
 
+    def fetchDevices(self):
+        '''Download devices inventory'''
+        return self.readDevices(self.sendRequest("/devices", stream=self.stream))
+
+    def readDevices(self, resp):
+        '''Read devices inventory from a /devices response, keeping its validators'''
+        self.etag = resp.headers.get('ETag')
+        self.last_modified = resp.headers.get('Last-Modified')
+
+        with profiler.phase('parse'):
+            if self.stream:
+                return list(self.iterDevices(resp))
+            return resp.json()['results']
+
+    def iterDevices(self, resp=None):
+        '''Download devices inventory, yielding every device as soon as it is parsed
+
+        Devices only keep the properties in `stream_properties`.
+        '''
+        if resp is None:
+            resp = self.sendRequest("/devices", stream=True)
+        try:
+            for dev in iter_json_array(resp.iter_content(chunk_size=1 << 16), 'results'):
+                if 'properties' in dev:
+                    dev['properties'] = {
+                        name: value for name, value in dev['properties'].items()
+                        if name.startswith(self.stream_properties)
+                    }
+                yield dev
+        finally:
+            resp.close()
+
     def getDevices(self, name_starts=None, name=None, ip=None, mac=None):
-        '''Get devices list, as a list of dicts (from JSON data)'''
+        '''Get devices list, as a list of dicts (from JSON data)
+
+        `ip` can be an IP, a CIDR network or a `first-last` range, looked up
+        in the IP index. Other strings are matched as IP substrings.
+        '''
 
         if mac is not None:
             return self.getDeviceByMac(mac)
 
         if not self.devices:
-            self.devices = self.sendRequest("/devices").json()['results']
+            self.devices = self.fetchDevices()
+            self.ip_index = None
+            self.topology = None
 
         if name:
             name = name.lower()
@@ -235,6 +396,10 @@ class ACSession():
         if mac:
             mac = mac.lower()
 
+        ip_range = parse_ip_range(ip) if ip else None
+        if ip_range and not name_starts and not name:
+            return self.getIPIndex().range(*ip_range)
+
         if not name_starts and not name and not ip and not mac:
             result = self.devices
         else:
@@ -246,12 +411,127 @@ class ACSession():
                     (name_starts and dev['properties']['hostname'].lower().startswith(name_starts)) or
                     (name and name in dev['properties']['hostname'].lower()) or
                     (mac and mac in dev['properties']['mac'].lower()) or
-                    (ip and ip in int2ip(dev['properties']['ip']))
+                    (ip_range and 'ip' in dev['properties'] and
+                        ip_range[0] <= dev['properties']['ip'] <= ip_range[1]) or
+                    (ip and not ip_range and ip in int2ip(dev['properties']['ip']))
                 )
             ]
 
         return result
 
+    @staticmethod
+    def deviceKey(dev):
+        '''Key of a device in this inventory: its deviceId'''
+        return dev['deviceId']
+
+    @staticmethod
+    def parentKey(dev):
+        '''Key of a device's parent in this inventory, if any'''
+        return dev.get('parentId')
+
+    @staticmethod
+    def deviceHash(dev):
+        '''Content hash of a device JSON'''
+        return hashlib.sha1(json.dumps(
+            dev, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+    def refresh(self):
+        '''Update devices inventory, returning the changes
+
+        The inventory is asked conditionally (ETag/Last-Modified) if the
+        server gave validators, so an unchanged inventory is not downloaded
+        again. Otherwise, devices are compared by content hash: unchanged
+        devices keep their objects, and modified ones are updated in place.
+        Returns a dict with the `added`, `removed` and `modified` devices.
+        '''
+        headers = {}
+        if self.devices:
+            if self.etag:
+                headers['If-None-Match'] = self.etag
+            if self.last_modified:
+                headers['If-Modified-Since'] = self.last_modified
+
+        resp = self.sendRequest("/devices", stream=self.stream, headers=headers)
+        if resp.status_code == 304:
+            resp.close()
+            return {'added': [], 'removed': [], 'modified': []}
+
+        return self.updateDevices(self.readDevices(resp))
+
+    def updateDevices(self, devices):
+        '''Replace devices inventory, changing only modified devices. Returns the changes'''
+        old = {self.deviceKey(dev): dev for dev in self.devices or []}
+        if self.hashes is None:
+            self.hashes = {id: self.deviceHash(dev) for id, dev in old.items()}
+
+        changes = {'added': [], 'removed': [], 'modified': []}
+        hashes = {}
+        result = []
+        for dev in devices:
+            id = self.deviceKey(dev)
+            hashes[id] = self.deviceHash(dev)
+
+            if id not in old:
+                changes['added'].append(dev)
+            elif self.hashes.get(id) != hashes[id]:
+                if old[id] is not dev:
+                    old[id].clear()
+                    old[id].update(dev)
+                dev = old[id]
+                changes['modified'].append(dev)
+            else:
+                dev = old[id]
+            result.append(dev)
+
+        changes['removed'] = [dev for id, dev in old.items() if id not in hashes]
+
+        self.devices = result
+        self.hashes = hashes
+        if any(changes.values()):
+            self.ip_index = None
+            self.topology = None
+
+        return changes
+
+    def getIPIndex(self):
+        '''Index of devices by their IP'''
+        if self.ip_index is None:
+            if not self.devices:
+                self.getDevices()
+            self.ip_index = IPIndex(
+                self.devices, key=lambda dev: dev.get('properties', {}).get('ip'))
+
+        return self.ip_index
+
+    def getTopology(self):
+        '''Network tree of devices, from their parentId'''
+        if self.topology is None:
+            if not self.devices:
+                self.getDevices()
+            self.topology = Topology(
+                self.devices, key=self.deviceKey, parent=self.parentKey)
+
+        return self.topology
+
+    def getDeviceRecords(self, *args, **kwargs):
+        '''Get devices list as compact records, loading their full JSON lazily'''
+        return [
+            DeviceRecord.from_aircontrol(
+                dev, loader=lambda record: self.getDeviceById(record.key, full=True), status=STATUS)
+            for dev in self.getDevices(*args, **kwargs)
+        ]
+
+    def getDeviceById(self, id, full=False):
+        '''Gets device by it's ID, from inventory if already downloaded
+
+        With `full`, streamed inventories (with only some properties) are not used.
+        '''
+        if self.devices and not (full and self.stream):
+            for dev in self.devices:
+                if dev['deviceId'] == id:
+                    return dev
+        return self.sendRequest("/devices/{}".format(id)).json()
+
     def getDeviceByMac(self, mac):
         '''Gets device by it's MAC address'''
         return self.sendRequest("/devices/mac/{}".format(mac)).json()
@@ -269,10 +549,10 @@ class ACSession():
         return result.json()
 
     def getDevicesURL(self, list):
-        '''Get device's URL'''
+        '''Get devices authenticated WebUI URLs, as {deviceId: url}. Devices not found are left out'''
         result = self.sendRequest(
             "/devices/webui", method='post', body=str(list))
-        return result.json()['results']
+        return {url['deviceId']: url['url'] for url in result.json()['results']}
 
     @staticmethod
     def patchDeviceCreate(deviceId, patchDevice):
@@ -326,3 +606,178 @@ class ACSession():
         '''Patch device basic properties'''
 
         return self.patchDeviceList([self.patchDeviceCreate(deviceId, patchDevice)])
+
+
+class ACFederation(ACSession):
+    '''Several AirControl servers seen as a single one
+
+    Logins and inventory downloads run concurrently on every server. The
+    merged inventory is deduplicated by MAC address (first server wins), and
+    every device is tagged with its server name under the `controller` key.
+    As deviceIds are only unique within a server, merged devices are keyed
+    by (server name, deviceId), and requests about devices are routed to the
+    server in their key. Bare deviceIds are accepted only when a single
+    server has them.
+    '''
+
+    sessions = None
+    owners = None
+    errors = None
+
+    def __init__(self, sessions):
+        '''Federate a dict of named ACSession'''
+        self.sessions = sessions
+        self.owners = {}
+        self.errors = {}
+
+    def parallel(self, func, names=None):
+        '''Run `func(name)` concurrently for every session. Returns {name: result} and saves this call errors'''
+        names = list(self.sessions) if names is None else names
+        results = {}
+        self.errors = {}
+        for name, result, error in parallel_map(func, names):
+            if error is not None:
+                self.errors[name] = error
+            else:
+                results[name] = result
+
+        return results
+
+    def login(self):
+        '''Login to every AirControl server. Fails only if all of them fail'''
+        results = self.parallel(lambda name: self.sessions[name].login())
+
+        if not results:
+            raise Exception(u'Login failed on every AirControl server: {}'.format(
+                pformat({name: str(e) for name, e in self.errors.items()})))
+
+        # Forget failed servers
+        for name in self.errors:
+            del self.sessions[name]
+
+    def sendRequest(self, path, method="get", body=None, stream=False, headers=None):
+        raise NotImplementedError(
+            "Requests must be sent to one of the federated sessions")
+
+    @staticmethod
+    def deviceKey(dev):
+        '''Key of a device in the merged inventory: (server name, deviceId)'''
+        return dev['controller'], dev['deviceId']
+
+    @staticmethod
+    def parentKey(dev):
+        '''Key of a device's parent, on the same server'''
+        if dev.get('parentId') is None:
+            return None
+        return dev['controller'], dev['parentId']
+
+    def split(self, key):
+        '''(server name, deviceId) of a device key, or None if no server has it'''
+        if not self.devices:
+            self.getDevices()
+
+        if isinstance(key, tuple):
+            return key if key[0] in self.owners.get(key[1], []) else None
+
+        names = self.owners.get(key, [])
+        if len(names) > 1:
+            raise Exception(u'Device {} is on several AirControl servers ({}): use (server, deviceId)'.format(
+                key, ", ".join(names)))
+        return (names[0], key) if names else None
+
+    def fetchDevices(self):
+        '''Download every inventory concurrently and merge them
+
+        Fails if any inventory can't be downloaded: a partial inventory
+        would look like that server's devices were removed.
+        '''
+        inventories = self.parallel(lambda name: self.sessions[name].getDevices())
+        if self.errors:
+            raise Exception(u'Inventory download failed on some AirControl servers: {}'.format(
+                pformat({name: str(e) for name, e in self.errors.items()})))
+
+        devices = []
+        seen = set()
+        self.owners = {}
+        for name in self.sessions:
+            for dev in inventories[name]:
+                mac = dev.get('properties', {}).get('mac', "").lower()
+                if mac and mac in seen:
+                    continue
+                seen.add(mac)
+
+                # Tag a copy: the server's own inventory stays as it sent it
+                dev = dict(dev, controller=name)
+                self.owners.setdefault(dev['deviceId'], []).append(name)
+                devices.append(dev)
+
+        return devices
+
+    def refresh(self):
+        '''Refresh every inventory concurrently, and merge them again if any changed'''
+        if not self.devices:
+            return self.updateDevices(self.fetchDevices())
+
+        changes = self.parallel(lambda name: self.sessions[name].refresh())
+        if not any(any(change.values()) for change in changes.values()):
+            return {'added': [], 'removed': [], 'modified': []}
+
+        return self.updateDevices(self.fetchDevices())
+
+    def ownersOf(self, keys):
+        '''Group device keys by the servers owning them: {name: [deviceId]}. Unknown keys are left out'''
+        groups = {}
+        for key in keys:
+            found = self.split(key)
+            if found is not None:
+                groups.setdefault(found[0], []).append(found[1])
+
+        return groups
+
+    def owner(self, key):
+        found = self.split(key)
+        if found is None:
+            raise Exception(u'Device {} not found on any AirControl server'.format(key))
+        return found
+
+    def getDeviceById(self, id, full=False):
+        name, id = self.owner(id)
+        return self.sessions[name].getDeviceById(id, full=full)
+
+    def getDeviceByMac(self, mac):
+        for name, result in self.parallel(lambda name: self.sessions[name].getDeviceByMac(mac)).items():
+            if result:
+                return result
+        return None
+
+    def getDeviceStatus(self, id):
+        name, id = self.owner(id)
+        return self.sessions[name].getDeviceStatus(id)
+
+    def getDevicesURL(self, list):
+        '''Get devices URLs, as {key: url} for the keys asked. Devices not found are left out'''
+        groups = self.ownersOf(list)
+        results = self.parallel(
+            lambda name: self.sessions[name].getDevicesURL(groups[name]), names=[*groups])
+
+        urls = {}
+        for key in list:
+            found = self.split(key)
+            if found is not None and found[1] in results.get(found[0], {}):
+                urls[key] = results[found[0]][found[1]]
+        return urls
+
+    def patchDeviceList(self, patchList):
+        '''Patch devices basic properties, sending every patch only to its device's server
+
+        Patches `deviceId` can be device keys.
+        '''
+        groups = {}
+        for patch in patchList:
+            found = self.split(patch['deviceId'])
+            if found is not None:
+                groups.setdefault(found[0], []).append(
+                    dict(patch, deviceId=found[1]))
+
+        return self.parallel(
+            lambda name: self.sessions[name].patchDeviceList(groups[name]), names=[*groups])
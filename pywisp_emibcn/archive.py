@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import gzip
+import sqlite3
+import tarfile
+import threading
+
+# Backup files, as named by `SSHDevice.setBackupName`
+BACKUP_RE = re.compile(
+    r'^(?P<name>.+)\.(?P<date>\d{4}-\d{2}-\d{2})\.bkp(?P<tar>\.tar)?(?:\.gz)?$')
+
+# Config files worth indexing inside AirOS tars
+TAR_MEMBERS = ("system.cfg", "rc.prestart", "rc.poststart")
+
+
+def parse_backup_name(file):
+    '''(device, date, is_tar) of a backup file name, or None if it is not a backup'''
+    match = BACKUP_RE.match(os.path.basename(file))
+    if match is None:
+        return None
+    return match.group('name'), match.group('date'), bool(match.group('tar'))
+
+
+def iter_backup_documents(file):
+    '''Yield (member, text) of every config inside a backup file, streaming it
+
+    AirOS tars yield their config files, RouterOS exports yield themselves.
+    '''
+    name = parse_backup_name(file)
+    if name is None:
+        return
+
+    if name[2]:
+        with tarfile.open(file, mode='r|*') as tar:
+            for member in tar:
+                if member.isfile() and os.path.basename(member.name) in TAR_MEMBERS:
+                    data = tar.extractfile(member).read()
+                    yield member.name, data.decode('utf-8', errors='replace')
+        return
+
+    opener = gzip.open if file.endswith(".gz") else open
+    with opener(file, "rb") as f:
+        yield "export", f.read().decode('utf-8', errors='replace')
+
+
+class ArchiveIndex():
+    '''Full text index of the config files in a backups directory
+
+    Kept in `.index.sqlite`, using SQLite FTS5 when available (plain LIKE
+    scans otherwise). `update` only reads new or changed backup files.
+    '''
+
+    file_name = ".index.sqlite"
+    fts = True
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(path, self.file_name),
+                                  check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS files "
+            "(file TEXT PRIMARY KEY, mtime REAL, size INTEGER, device TEXT, date TEXT)")
+        if self.fts:
+            try:
+                self.db.execute(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS documents USING fts5"
+                    "(file UNINDEXED, device, date UNINDEXED, member UNINDEXED, content)")
+            except sqlite3.OperationalError:
+                self.fts = False
+        if not self.fts:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS documents "
+                "(file TEXT, device TEXT, date TEXT, member TEXT, content TEXT)")
+        self.db.commit()
+
+    def update(self):
+        '''Index new and changed backups, forget removed ones. Returns the number of files indexed'''
+        indexed = {file: (mtime, size) for file, mtime, size in
+                   self.db.execute("SELECT file, mtime, size FROM files")}
+
+        count = 0
+        present = set()
+        with self.lock:
+            for entry in os.scandir(self.path):
+                name = parse_backup_name(entry.name)
+                if name is None or not entry.is_file():
+                    continue
+                present.add(entry.name)
+
+                stat = entry.stat()
+                if indexed.get(entry.name) == (stat.st_mtime, stat.st_size):
+                    continue
+
+                self.forget(entry.name)
+                try:
+                    documents = list(iter_backup_documents(entry.path))
+                except (OSError, EOFError, tarfile.TarError):
+                    # Broken backup: don't index it, nor try it again
+                    documents = []
+                self.db.executemany(
+                    "INSERT INTO documents (file, device, date, member, content) VALUES (?, ?, ?, ?, ?)",
+                    [(entry.name, name[0], name[1], member, text) for member, text in documents])
+                self.db.execute(
+                    "INSERT INTO files (file, mtime, size, device, date) VALUES (?, ?, ?, ?, ?)",
+                    (entry.name, stat.st_mtime, stat.st_size, name[0], name[1]))
+                count += 1
+
+            for file in set(indexed) - present:
+                self.forget(file)
+
+            self.db.commit()
+
+        return count
+
+    def forget(self, file):
+        self.db.execute("DELETE FROM documents WHERE file = ?", (file,))
+        self.db.execute("DELETE FROM files WHERE file = ?", (file,))
+
+    def search(self, term, device=None, latest=False, limit=None):
+        '''Find backups containing `term`
+
+        Returns a list of dicts with the device, date, file, member and the
+        matching lines, newest first. With `latest`, only each device's
+        newest backup is looked at.
+        '''
+        if self.fts:
+            query = "SELECT file, device, date, member, content FROM documents WHERE documents MATCH ?"
+            arguments = ['content : "{}"'.format(term.replace('"', '""'))]
+        else:
+            # Wildcards in the term are searched literally
+            query = "SELECT file, device, date, member, content FROM documents WHERE content LIKE ? ESCAPE '\\'"
+            arguments = ['%{}%'.format(
+                term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_'))]
+
+        if device is not None:
+            query += " AND device = ?"
+            arguments.append(device)
+        if latest:
+            query += " AND date = (SELECT MAX(date) FROM files WHERE files.device = documents.device)"
+        query += " ORDER BY date DESC, device"
+        if limit is not None:
+            query += " LIMIT {:d}".format(limit)
+
+        lowered = term.lower()
+        results = []
+        for file, device, date, member, content in self.db.execute(query, arguments):
+            lines = [line for line in content.splitlines() if lowered in line.lower()]
+            results.append({
+                'device': device,
+                'date': date,
+                'file': os.path.join(self.path, file),
+                'member': member,
+                'lines': lines,
+            })
+
+        return results
+
+    def close(self):
+        self.db.close()
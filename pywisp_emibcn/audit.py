@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import json
+import sqlite3
+import hashlib
+import tarfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pywisp_emibcn.archive import parse_backup_name, iter_backup_documents
+
+# RouterOS export tokens: `[ find ... ]`, `key=value`, `"quoted"` or words
+TOKEN_RE = re.compile(
+    r'\[[^\]]*\]|[^\s=]+=(?:"(?:[^"\\]|\\.)*"|\S*)|"(?:[^"\\]|\\.)*"|\S+')
+
+EXPORT_ACTIONS = ('add', 'set')
+
+# RouterOS export header comments
+VERSION_RE = re.compile(r'by RouterOS (\S+)')
+HEADER_RE = re.compile(r'#\s*(model|software id)\s*=\s*(.*)$')
+
+
+def parse_system_cfg(text):
+    '''AirOS `system.cfg` into a {key: value} dict'''
+    config = {}
+    for line in text.splitlines():
+        if '=' in line and not line.startswith('#'):
+            key, value = line.split('=', 1)
+            config[key.strip()] = value.strip()
+    return config
+
+
+def unquote(value):
+    if len(value) > 1 and value[0] == value[-1] == '"':
+        return value[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+    return value
+
+
+def parse_export(text):
+    '''RouterOS export into a flat {key: value} dict
+
+    Keys are `<menu>.<property>` for menu settings (`/ip dns.servers`),
+    `<menu> <item>.<property>` for settings of an item
+    (`/ip service telnet.disabled`, `/interface ethernet default-name=ether1.name`)
+    and `<menu>[<n>].<property>` for added items (`/ip address[0].address`).
+    Header comments give `version`, `model` and `software-id`.
+    '''
+    config = {}
+
+    # Join continued lines
+    lines = []
+    for line in text.splitlines():
+        if lines and lines[-1].endswith('\\'):
+            lines[-1] = lines[-1][:-1] + line.strip()
+        else:
+            lines.append(line.strip())
+
+    menu = ""
+    added = {}
+    for line in lines:
+        if not line:
+            continue
+
+        if line.startswith('#'):
+            match = VERSION_RE.search(line)
+            if match:
+                config['version'] = match.group(1)
+            match = HEADER_RE.match(line)
+            if match:
+                config[match.group(1).replace(' ', '-')] = match.group(2).strip()
+            continue
+
+        tokens = TOKEN_RE.findall(line)
+        if tokens[0].startswith('/'):
+            words = []
+            while tokens and tokens[0] not in EXPORT_ACTIONS:
+                words.append(tokens.pop(0))
+            menu = " ".join(words)
+            if not tokens:
+                continue
+
+        action, arguments = tokens[0], tokens[1:]
+        if action not in EXPORT_ACTIONS:
+            continue
+
+        item = None
+        properties = {}
+        for token in arguments:
+            if token.startswith('['):
+                item = token.strip('[] ')
+                if item.startswith('find'):
+                    item = item[4:].strip()
+            elif '=' in token:
+                key, value = token.split('=', 1)
+                properties[key] = unquote(value)
+            else:
+                item = unquote(token)
+
+        if action == 'add':
+            prefix = "{}[{}]".format(menu, added.get(menu, 0))
+            added[menu] = added.get(menu, 0) + 1
+        elif item:
+            prefix = "{} {}".format(menu, item)
+        else:
+            prefix = menu
+
+        for key, value in properties.items():
+            config["{}.{}".format(prefix, key)] = value
+
+    return config
+
+
+def parse_backup(file):
+    '''Backup file into (format, flat config dict): `airos` tars or `routeros` exports'''
+    name = parse_backup_name(file)
+    if name is not None and name[2]:
+        config = {}
+        for member, text in iter_backup_documents(file):
+            if os.path.basename(member) == "system.cfg":
+                config.update(parse_system_cfg(text))
+        return 'airos', config
+
+    text = "".join(text for member, text in iter_backup_documents(file))
+    return 'routeros', parse_export(text)
+
+
+def check(rule, value):
+    '''Does a value comply with a rule?'''
+    if value is None:
+        value = rule.get('default')
+    if 'present' in rule:
+        return (value is not None) == rule['present']
+    if value is None:
+        return False
+    if 'equals' in rule and value != str(rule['equals']):
+        return False
+    if 'in' in rule and value not in [str(v) for v in rule['in']]:
+        return False
+    if 'not_in' in rule and value in [str(v) for v in rule['not_in']]:
+        return False
+    if 'regex' in rule and not re.search(rule['regex'], value):
+        return False
+    if 'not_regex' in rule and re.search(rule['not_regex'], value):
+        return False
+    return True
+
+
+def evaluate(format, config, rules):
+    '''List of rules violations of a parsed config
+
+    Every rule checks the value of a `key` (or every key fully matching the
+    `keys` regex) with `equals`, `in`, `not_in`, `regex`, `not_regex` or
+    `present`, using `default` for missing keys. Rules apply only to their
+    `format`, if any, and to configs whose keys match every `when` regex.
+    '''
+    violations = []
+    for rule in rules:
+        if rule.get('format', format) != format:
+            continue
+        if not all(key in config and re.search(regex, config[key])
+                   for key, regex in rule.get('when', {}).items()):
+            continue
+
+        if 'keys' in rule:
+            keys = [key for key in config if re.fullmatch(rule['keys'], key)]
+        else:
+            keys = [rule['key']]
+
+        for key in keys:
+            value = config.get(key)
+            if not check(rule, value):
+                violations.append({
+                    'rule': rule['id'],
+                    'key': key,
+                    'value': value,
+                    'message': rule.get('description', ""),
+                })
+
+    return violations
+
+
+def audit_file(file, rules):
+    '''Parse and audit a backup file, in a worker process. Returns (hash, format, config, violations)'''
+    with open(file, "rb") as f:
+        checksum = hashlib.sha256(f.read()).hexdigest()
+    try:
+        format, config = parse_backup(file)
+    except (OSError, EOFError, tarfile.TarError) as e:
+        return checksum, None, {}, [{'rule': 'unreadable', 'key': None, 'value': None,
+                                     'message': str(e)}]
+    return checksum, format, config, evaluate(format, config, rules)
+
+
+def audit_config(parsed, rules):
+    '''Audit an already parsed (format, config), in a worker process'''
+    return evaluate(parsed[0], parsed[1], rules)
+
+
+class Audit():
+    '''Audit of the backups in a directory against a rules set
+
+    Parsed configs are cached in `.audit.sqlite` by content hash, together
+    with their results by rules set, so re-audits only parse changed backups
+    and only evaluate new rules sets. Unreadable backups are not cached, so
+    they are parsed, and reported, on every audit. Parsing and evaluation run on a pool
+    of `processes` (all CPUs by default, none with 0).
+    '''
+
+    file_name = ".audit.sqlite"
+
+    def __init__(self, path, processes=None):
+        self.path = path
+        self.processes = processes if processes is not None else os.cpu_count() or 1
+        self.db = sqlite3.connect(os.path.join(path, self.file_name))
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS files
+                (file TEXT PRIMARY KEY, mtime REAL, size INTEGER, hash TEXT);
+            CREATE TABLE IF NOT EXISTS configs
+                (hash TEXT PRIMARY KEY, format TEXT, config TEXT);
+            CREATE TABLE IF NOT EXISTS results
+                (hash TEXT, rules TEXT, violations TEXT, PRIMARY KEY (hash, rules));
+        ''')
+
+    def backups(self, latest=True):
+        '''Backup files to audit: (file, device, date), only each device's latest one by default'''
+        backups = {}
+        for entry in os.scandir(self.path):
+            name = parse_backup_name(entry.name)
+            if name is None or not entry.is_file():
+                continue
+            key = name[0] if latest else entry.name
+            if key not in backups or backups[key][2] < name[1]:
+                backups[key] = (entry.name, name[0], name[1])
+
+        return sorted(backups.values())
+
+    def map(self, func, *iterables):
+        if not self.processes:
+            return list(map(func, *iterables))
+        with ProcessPoolExecutor(max_workers=self.processes,
+                                 mp_context=multiprocessing.get_context('spawn')) as pool:
+            return list(pool.map(func, *iterables, chunksize=16))
+
+    def run(self, rules, latest=True):
+        '''Audit backups. Returns a list of dicts with device, date, file and violations'''
+        rules_hash = hashlib.sha1(json.dumps(
+            rules, sort_keys=True).encode()).hexdigest()
+        known = {file: (mtime, size, checksum) for file, mtime, size, checksum in
+                 self.db.execute("SELECT file, mtime, size, hash FROM files")}
+
+        backups = self.backups(latest=latest)
+        hashes = {}
+        changed = []
+        for file, device, date in backups:
+            stat = os.stat(os.path.join(self.path, file))
+            entry = known.get(file)
+            if entry and entry[:2] == (stat.st_mtime, stat.st_size):
+                hashes[file] = entry[2]
+            else:
+                changed.append((file, stat))
+
+        violations = {}
+
+        # Changed backups: parse and audit them
+        audited = self.map(audit_file, [os.path.join(self.path, file) for file, stat in changed],
+                           [rules] * len(changed))
+        for (file, stat), (checksum, format, config, found) in zip(changed, audited):
+            hashes[file] = checksum
+            violations[checksum] = found
+            if format is None:
+                continue
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                            (file, stat.st_mtime, stat.st_size, checksum))
+            self.db.execute("INSERT OR REPLACE INTO configs VALUES (?, ?, ?)",
+                            (checksum, format, json.dumps(config)))
+            self.db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?)",
+                            (checksum, rules_hash, json.dumps(found)))
+
+        # Unchanged backups: reuse their results, or audit their parsed config
+        pending = []
+        for checksum in set(hashes.values()) - set(violations):
+            row = self.db.execute("SELECT violations FROM results WHERE hash = ? AND rules = ?",
+                                  (checksum, rules_hash)).fetchone()
+            if row is not None:
+                violations[checksum] = json.loads(row[0])
+            else:
+                pending.append(checksum)
+
+        parsed = [self.db.execute("SELECT format, config FROM configs WHERE hash = ?",
+                                  (checksum,)).fetchone() for checksum in pending]
+        parsed = [(format, json.loads(config)) for format, config in parsed]
+        for checksum, found in zip(pending, self.map(audit_config, parsed, [rules] * len(parsed))):
+            violations[checksum] = found
+            self.db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?)",
+                            (checksum, rules_hash, json.dumps(found)))
+
+        self.db.commit()
+
+        return [{
+            'device': device,
+            'date': date,
+            'file': os.path.join(self.path, file),
+            'violations': violations[hashes[file]],
+        } for file, device, date in backups]
+
+    def close(self):
+        self.db.close()
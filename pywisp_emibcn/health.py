@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import errno
+import socket
+import selectors
+from pywisp_emibcn.store import JSONStore
+
+
+def tcp_probe(ip, port=22, timeout=1.0):
+    '''Cheap reachability check: can a TCP connection be opened?'''
+    try:
+        with socket.create_connection((ip, port), timeout=timeout):
+            return True
+    except (OSError, socket.timeout):
+        return False
+
+
+def tcp_scan(hosts, port=22, timeout=1.0, batch=1024):
+    '''Concurrent reachability check of many hosts using non-blocking TCP connects
+
+    Returns the set of hosts accepting connections on `port`. Hosts are
+    scanned in batches of `batch` sockets to keep file descriptors bounded.
+    '''
+    hosts = list(dict.fromkeys(hosts))
+    reachable = set()
+
+    for first in range(0, len(hosts), batch):
+        selector = selectors.DefaultSelector()
+        try:
+            for host in hosts[first:first + batch]:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setblocking(False)
+                try:
+                    result = sock.connect_ex((host, port))
+                except OSError:
+                    sock.close()
+                    continue
+                if result == 0:
+                    reachable.add(host)
+                    sock.close()
+                elif result in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                    selector.register(sock, selectors.EVENT_WRITE, host)
+                else:
+                    sock.close()
+
+            # Wait for connections to finish, until timeout
+            deadline = time.monotonic() + timeout
+            while selector.get_map():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                for key, _ in selector.select(remaining):
+                    sock = key.fileobj
+                    if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                        reachable.add(key.data)
+                    selector.unregister(sock)
+                    sock.close()
+        finally:
+            for key in list(selector.get_map().values()):
+                key.fileobj.close()
+            selector.close()
+
+    return reachable
+
+
+class HostHealth(JSONStore):
+    '''Persistent per-host health record with a fast-fail circuit breaker
+
+    Every host keeps its consecutive failed runs and an exponentially
+    weighted average of its observed login latency. Hosts with `threshold`
+    or more consecutive failures get a cheap TCP probe before any SSH
+    connection is tried, and are skipped if the probe fails.
+    '''
+
+    # Consecutive failed runs before fast-failing a host
+    threshold = 2
+
+    # Adaptive timeout: `factor` times the observed latency, bounded
+    factor = 4
+    min_timeout = 1.0
+    max_timeout = 5.0
+
+    # TCP probe timeout for hosts with open circuit
+    probe_timeout = 1.0
+
+    # Weight of the newest latency sample
+    alpha = 0.3
+
+    def __init__(self, path=None):
+        super().__init__(path)
+        # Open circuit hosts which answered a probe during this run
+        self.answered = set()
+
+    def record(self, host):
+        '''Get host health record'''
+        return self.get(host, {
+            'failures': 0,
+            'latency': None,
+            'last_ok': None,
+            'last_failure': None,
+        })
+
+    def success(self, host, latency=None):
+        '''Reset failures counter and update observed latency'''
+        with self.lock:
+            record = self.record(host)
+            record['failures'] = 0
+            record['last_ok'] = time.time()
+            if latency is not None:
+                if record['latency'] is None:
+                    record['latency'] = latency
+                else:
+                    record['latency'] = self.alpha * latency + \
+                        (1 - self.alpha) * record['latency']
+            self[host] = record
+
+    def failure(self, host):
+        '''Count a failed run'''
+        with self.lock:
+            record = self.record(host)
+            record['failures'] += 1
+            record['last_failure'] = time.time()
+            self[host] = record
+
+    def is_open(self, host):
+        '''Has the host failed enough consecutive runs to fast-fail it?'''
+        return self.record(host)['failures'] >= self.threshold
+
+    def timeout(self, host):
+        '''Connect and login timeout adapted to the host's observed latency'''
+        latency = self.record(host)['latency']
+        if latency is None:
+            return self.max_timeout
+        return min(self.max_timeout, max(self.min_timeout, self.factor * latency))
+
+    def allow(self, host, port=22):
+        '''Should we try to connect to the host? Probe it first if its circuit is open'''
+        if not self.is_open(host):
+            return True
+        return tcp_probe(host, port, timeout=self.probe_timeout)
+
+    def allowed(self, hosts, port=22):
+        '''Set of `hosts` we should try to connect to
+
+        Hosts with open circuit are probed all at once, and only once per
+        run: those answering aren't probed again on retries.
+        '''
+        hosts = set(hosts)
+        closed = {host for host in hosts if not self.is_open(host)}
+        probe = hosts - closed - self.answered
+        if probe:
+            self.answered |= tcp_scan(probe, port, timeout=self.probe_timeout)
+        return closed | (hosts & self.answered)
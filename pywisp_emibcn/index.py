@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import bisect
+from pywisp_emibcn.match import parse_ip_range
+
+
+class IPIndex():
+    '''Sorted integer IP index
+
+    Exact IP, CIDR network and range lookups are answered with two bisections
+    plus a slice: O(log n + k), without converting any IP to string.
+    '''
+
+    def __init__(self, items, key):
+        '''Index `items` by the integer IP returned by `key`. Items without IP are ignored'''
+        pairs = [(key(item), item) for item in items]
+        pairs = sorted([pair for pair in pairs if pair[0] is not None],
+                       key=lambda pair: pair[0])
+
+        self.ips = [ip for ip, item in pairs]
+        self.items = [item for ip, item in pairs]
+
+    def range(self, first, last):
+        '''Items with IP between `first` and `last` integers, both included'''
+        lo = bisect.bisect_left(self.ips, first)
+        hi = bisect.bisect_right(self.ips, last)
+        return self.items[lo:hi]
+
+    def lookup(self, query):
+        '''Items matching an IP, a CIDR network or a `first-last` range string
+
+        Returns None if the query is none of them.
+        '''
+        ip_range = parse_ip_range(query)
+        if ip_range is None:
+            return None
+        return self.range(*ip_range)
+
+    def __len__(self):
+        return len(self.ips)
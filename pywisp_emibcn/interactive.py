@@ -17,18 +17,24 @@
 # 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA.
 
 
+import os
+import codecs
+import select
 import socket
 import sys
-from paramiko.py3compat import u
 
 # windows does not have termios...
 try:
     import termios
     import tty
+    import fcntl
     has_termios = True
 except ImportError:
     has_termios = False
 
+# Bytes read at once from channel or stdin
+BUFFER_SIZE = 32768
+
 
 def interactive_shell(chan):
     if has_termios:
@@ -37,35 +43,59 @@ def interactive_shell(chan):
         windows_shell(chan)
 
 
+def write_all(fd, data):
+    '''Write bytes to a file descriptor, even if it is non-blocking'''
+    view = memoryview(data)
+    while view:
+        try:
+            written = os.write(fd, view)
+        except BlockingIOError:
+            select.select([], [fd], [])
+            continue
+        view = view[written:]
+
+
 def posix_shell(chan):
-    import select
+    stdin = sys.stdin.fileno()
+    stdout = sys.stdout.fileno()
+    sys.stdout.flush()
 
-    oldtty = termios.tcgetattr(sys.stdin)
+    oldtty = termios.tcgetattr(stdin)
+    oldflags = fcntl.fcntl(stdin, fcntl.F_GETFL)
     try:
-        tty.setraw(sys.stdin.fileno())
-        tty.setcbreak(sys.stdin.fileno())
+        tty.setraw(stdin)
+        tty.setcbreak(stdin)
+        fcntl.fcntl(stdin, fcntl.F_SETFL, oldflags | os.O_NONBLOCK)
         chan.settimeout(0.0)
 
         while True:
-            r, w, e = select.select([chan, sys.stdin], [], [])
+            r, w, e = select.select([chan, stdin], [], [])
             if chan in r:
                 try:
-                    x = u(chan.recv(1024))
+                    # Raw bytes to stdout: no decoding, no split characters
+                    x = chan.recv(BUFFER_SIZE)
                     if len(x) == 0:
-                        sys.stdout.write('\r\n*** EOF\r\n')
+                        write_all(stdout, b'\r\n*** EOF\r\n')
                         break
-                    sys.stdout.write(x)
-                    sys.stdout.flush()
+                    write_all(stdout, x)
                 except socket.timeout:
                     pass
-            if sys.stdin in r:
-                x = sys.stdin.read(1)
+            if stdin in r:
+                try:
+                    x = os.read(stdin, BUFFER_SIZE)
+                except BlockingIOError:
+                    continue
                 if len(x) == 0:
                     break
-                chan.send(x)
+
+                # Block while sending, so big pastes wait for channel window
+                chan.settimeout(None)
+                chan.sendall(x)
+                chan.settimeout(0.0)
 
     finally:
-        termios.tcsetattr(sys.stdin, termios.TCSADRAIN, oldtty)
+        fcntl.fcntl(stdin, fcntl.F_SETFL, oldflags)
+        termios.tcsetattr(stdin, termios.TCSADRAIN, oldtty)
 
 
 # thanks to Mike Looijmans for this code
@@ -76,13 +106,16 @@ def windows_shell(chan):
         "Line-buffered terminal emulation. Press F6 or ^Z to send EOF.\r\n\r\n")
 
     def writeall(sock):
+        # Multibyte characters may be split between chunks
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
         while True:
-            data = sock.recv(256)
+            data = sock.recv(BUFFER_SIZE)
             if not data:
+                sys.stdout.write(decoder.decode(b'', final=True))
                 sys.stdout.write('\r\n*** EOF ***\r\n\r\n')
                 sys.stdout.flush()
                 break
-            sys.stdout.write(data)
+            sys.stdout.write(decoder.decode(data))
             sys.stdout.flush()
 
     writer = threading.Thread(target=writeall, args=(chan,))
@@ -90,10 +123,10 @@ def windows_shell(chan):
 
     try:
         while True:
-            d = sys.stdin.read(1)
+            d = sys.stdin.readline()
             if not d:
                 break
-            chan.send(d)
+            chan.sendall(d)
     except EOFError:
         # user hit ^Z or F6
         pass
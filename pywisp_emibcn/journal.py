@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+
+
+def file_checksum(file):
+    '''SHA-256 of a file contents'''
+    checksum = hashlib.sha256()
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+class BackupJournal():
+    '''Append-only journal of a backup run
+
+    Every device result is appended as one JSON line to `.journal.jsonl` in
+    the backup directory, and synced to disk, with its status, attempts
+    count, error class and the SHA-256 and size of the written file. A
+    resumed run continues the last run found in the journal: finished
+    devices whose file still matches its checksum are not backed up again,
+    and failed devices keep their attempts count.
+
+    Only the last run matters: a new run truncates the journal, and a
+    resumed run compacts it to the latest record of every device.
+    '''
+
+    file_name = ".journal.jsonl"
+    path = None
+    run = None
+    started = None
+    resumed = False
+    devices = None
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.devices = {}
+        self.lock = threading.Lock()
+
+        if resume:
+            self.load()
+            self.resumed = self.run is not None
+
+        os.makedirs(path, exist_ok=True)
+        if self.resumed:
+            self.compact()
+            self.journal = open(os.path.join(path, self.file_name), "a")
+        else:
+            self.devices = {}
+            self.run = time.strftime('%Y%m%d%H%M%S')
+            self.journal = open(os.path.join(path, self.file_name), "w")
+            self.append({'run': self.run, 'started': time.time()})
+
+    def load(self):
+        '''Load the state of the last run from the journal'''
+        file = os.path.join(self.path, self.file_name)
+        if not os.path.isfile(file):
+            return
+
+        with open(file, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Last line may be truncated by a crash
+                    continue
+
+                if 'started' in record:
+                    self.run = record['run']
+                    self.started = record['started']
+                    self.devices = {}
+                elif record.get('run') == self.run:
+                    self.devices[record['host']] = record
+
+    def compact(self):
+        '''Atomically rewrite the journal with the last run state only'''
+        file = os.path.join(self.path, self.file_name)
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                for record in [{'run': self.run, 'started': self.started}] + list(self.devices.values()):
+                    f.write(json.dumps(record, separators=(',', ':')) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, file)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def append(self, record):
+        with self.lock:
+            self.journal.write(json.dumps(
+                record, separators=(',', ':')) + "\n")
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+
+    def attempts(self, host):
+        '''Number of attempts done on this run'''
+        return self.devices.get(host, {}).get('attempts', 0)
+
+    def last_error(self, host):
+        return self.devices.get(host, {}).get('message', "")
+
+    def is_done(self, device):
+        '''Has the device current backup file been written on this run, and is it intact?'''
+        record = self.devices.get(device.ip)
+        if not record or record['status'] not in ('ok', 'unchanged', 'skipped'):
+            return False
+
+        # A run resumed on another day needs that day's backup
+        if record['file'] != device.backup_file:
+            return False
+
+        file = os.path.join(self.path, device.backup_file)
+        return os.path.isfile(file) and \
+            os.stat(file).st_size == record['size'] and \
+            file_checksum(file) == record['sha256']
+
+    def record(self, device, status, error=None, checksum=None, size=None):
+        '''Append a device result to the journal
+
+        The written file `checksum` and `size` are computed, if not given.
+        '''
+        record = {
+            'run': self.run,
+            'host': device.ip,
+            'file': device.backup_file,
+            'status': status,
+            'attempts': self.attempts(device.ip) + 1,
+            'time': time.time(),
+        }
+
+        if error is not None:
+            record['error'] = type(error).__name__
+            record['message'] = str(error)
+        else:
+            file = os.path.join(self.path, device.backup_file)
+            record['size'] = os.stat(file).st_size if size is None else size
+            record['sha256'] = file_checksum(file) if checksum is None else checksum
+
+        self.devices[device.ip] = record
+        self.append(record)
+
+    def close(self):
+        self.journal.close()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import re
+import json
+import codecs
+
+
+def iter_json_array(chunks, key, encoding='utf-8'):
+    '''Yield the items of the `key` array of a JSON object, one by one, from its raw chunks
+
+    Only the item being parsed is kept in memory, so items can be used as
+    soon as they are downloaded, whatever the size of the whole document.
+    The array is looked for as the first `"<key>": [` of the document.
+    '''
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder(encoding)()
+    start = re.compile(r'"{}"\s*:\s*\['.format(re.escape(key)))
+    blanks = re.compile(r'[\s,]*')
+
+    buffer = ""
+    found = False
+    for chunk in chunks:
+        buffer += text.decode(chunk)
+
+        if not found:
+            match = start.search(buffer)
+            if match is None:
+                # Keep enough text for a key split between chunks
+                buffer = buffer[-(len(key) + 64):]
+                continue
+            found = True
+            buffer = buffer[match.end():]
+
+        pos = 0
+        while True:
+            pos = blanks.match(buffer, pos).end()
+            if pos >= len(buffer):
+                break
+            if buffer[pos] == ']':
+                return
+            try:
+                item, pos = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                # Incomplete item: wait for more data
+                break
+            yield item
+
+        buffer = buffer[pos:]
+
+    if not found:
+        raise ValueError(u'No "{}" array found'.format(key))
+    raise ValueError(u'Truncated "{}" array'.format(key))
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+from pywisp_emibcn.store import JSONStore
+
+
+class LocationIndex(JSONStore):
+    '''Last known BR of every wifi client, persisted by client MAC
+
+    Filled with every BR station table downloaded, so deep lookups can ask
+    only the BR where a client was seen last. Entries older than `max_age`
+    seconds are ignored. BRs are identified by their AirControl server
+    (`controller`, on federations) and deviceId.
+    '''
+
+    max_age = 7 * 24 * 3600
+    stations = None
+
+    def load(self):
+        '''Load entries, and the clients MACs of every (controller, BR)'''
+        super().load()
+        self.stations = {}
+        for mac, entry in self.items():
+            self.stations.setdefault((entry.get('controller'), entry['br']), set()).add(mac)
+
+    def update(self, br, stations):
+        '''Record a BR full station table'''
+        now = time.time()
+        key = (br.controller, br.id)
+        seen = set()
+        with self.lock:
+            for station in stations:
+                mac = station.get('mac', "").lower()
+                if not mac:
+                    continue
+                seen.add(mac)
+
+                # Client moved from another BR
+                previous = self.get(mac)
+                if previous is not None and (previous.get('controller'), previous['br']) != key:
+                    self.stations.get((previous.get('controller'), previous['br']), set()).discard(mac)
+
+                self[mac] = {
+                    'br': br.id,
+                    'controller': br.controller,
+                    'ip': station.get('lastip', ""),
+                    'hostname': station['remote'].get('hostname', "")
+                    if 'remote' in station else station.get('name', ""),
+                    'signal': station.get('signal'),
+                    'seen': now,
+                }
+
+            # Clients not associated to this BR anymore
+            for mac in self.stations.get(key, set()) - seen:
+                del self[mac]
+            self.stations[key] = seen
+
+    def locate(self, matchers):
+        '''BRs, as (controller, deviceId), where clients matching a
+        `HostMatcherSet` were seen last, and the matchers found'''
+        brs = set()
+        found = set()
+        now = time.time()
+        for mac, entry in self.items():
+            if now - entry['seen'] > self.max_age:
+                continue
+            matched = matchers.match(
+                mac=mac, ip=entry['ip'], hostname=entry['hostname'])
+            if matched:
+                brs.add((entry.get('controller'), entry['br']))
+                found.update(matched)
+
+        return brs, found
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import re
+import ipaddress
+
+MAC_RE = re.compile(r'^[0-9a-f]{2}([:-]?[0-9a-f]{2}){5}$')
+
+
+def parse_ip_range(text):
+    '''Parses an IP, a CIDR network or a `first-last` range into a (first, last) integers tuple
+
+    Returns None if `text` is none of them.
+    '''
+    try:
+        if '/' in text:
+            network = ipaddress.IPv4Network(text, strict=False)
+            return int(network.network_address), int(network.broadcast_address)
+        if '-' in text:
+            first, last = text.split('-', 1)
+            return int(ipaddress.IPv4Address(first.strip())), int(ipaddress.IPv4Address(last.strip()))
+        ip = int(ipaddress.IPv4Address(text))
+        return ip, ip
+    except ValueError:
+        return None
+
+
+def parse_mac(text):
+    '''Parses a full MAC address into an integer, or None'''
+    if MAC_RE.match(text):
+        return int(re.sub('[:-]', '', text), 16)
+    return None
+
+
+class HostMatcher():
+    '''Host query, normalized once to be matched against many devices
+
+    Understood queries:
+     - A full MAC address: exact match
+     - An IP, a CIDR network (`10.20.0.0/16`) or a range (`10.1.1.1-10.1.1.20`)
+     - `re:<regex>`: hostname regular expression (case insensitive)
+     - `<prefix>*`: hostname prefix
+     - Anything else: substring of MAC, IP or hostname
+    '''
+
+    query = ""
+    mac = None
+    ip_range = None
+    regex = None
+    prefix = None
+    substring = None
+
+    def __init__(self, query):
+        self.query = query.lower().strip()
+
+        if self.query.startswith('re:'):
+            self.regex = re.compile(self.query[3:], re.IGNORECASE)
+        elif self.query.endswith('*'):
+            self.prefix = self.query[:-1]
+        else:
+            self.mac = parse_mac(self.query)
+            if self.mac is None:
+                self.ip_range = parse_ip_range(self.query)
+            if self.mac is None and self.ip_range is None:
+                self.substring = self.query
+
+    @property
+    def exact(self):
+        '''Does the query name a single host: a full MAC or a single IP?'''
+        return self.mac is not None or \
+            (self.ip_range is not None and self.ip_range[0] == self.ip_range[1])
+
+    def match(self, mac=None, ip=None, hostname=""):
+        '''Matches normalized values: MAC and IP as integers, lower hostname'''
+        if self.mac is not None:
+            return mac == self.mac
+        if self.ip_range is not None:
+            return ip is not None and self.ip_range[0] <= ip <= self.ip_range[1]
+        if self.regex is not None:
+            return bool(self.regex.search(hostname))
+        if self.prefix is not None:
+            return hostname.startswith(self.prefix)
+        return False
+
+    def match_text(self, mac="", ip="", hostname=""):
+        '''Matches the raw lowercase strings, for substring queries'''
+        return self.substring in mac or \
+            self.substring in ip or \
+            self.substring in hostname
+
+    def __repr__(self):
+        return u"<HostMatcher {}>".format(self.query)
+
+
+class HostMatcherSet():
+    '''Several host queries, matched together against a station table in one pass
+
+    Exact MAC and IP queries are looked up in dicts, so their cost does not
+    grow with the number of queries.
+    '''
+
+    def __init__(self, queries):
+        if isinstance(queries, (str, HostMatcher)):
+            queries = [queries]
+
+        self.matchers = [
+            q if isinstance(q, HostMatcher) else HostMatcher(q)
+            for q in queries
+        ]
+
+        self.macs = {}
+        self.ips = {}
+        self.others = []
+        self.substrings = []
+        for matcher in self.matchers:
+            if matcher.mac is not None:
+                self.macs.setdefault(matcher.mac, []).append(matcher)
+            elif matcher.exact:
+                self.ips.setdefault(matcher.ip_range[0], []).append(matcher)
+            elif matcher.substring is not None:
+                self.substrings.append(matcher)
+            else:
+                self.others.append(matcher)
+
+    def match(self, mac="", ip="", hostname=""):
+        '''List of matchers matching a device, given its raw MAC, IP and hostname strings'''
+        mac = mac.lower()
+        hostname = hostname.lower()
+
+        matched = []
+        if self.substrings:
+            matched += [m for m in self.substrings if m.match_text(mac, ip, hostname)]
+
+        mac_int = parse_mac(mac) if self.macs or self.others else None
+        ip_int = None
+        if self.ips or self.others:
+            try:
+                ip_int = int(ipaddress.IPv4Address(ip))
+            except ValueError:
+                pass
+
+        matched += self.macs.get(mac_int, [])
+        matched += self.ips.get(ip_int, [])
+        matched += [m for m in self.others
+                    if m.match(mac=mac_int, ip=ip_int, hostname=hostname)]
+
+        return matched
+
+    def match_stations(self, stations):
+        '''List of (station, matchers) for the stations of a `wstalist` matching any query'''
+        result = []
+        for station in stations:
+            hostname = station['remote'].get('hostname', "") \
+                if 'remote' in station else station.get('name', "")
+            matched = self.match(
+                mac=station.get('mac', ""), ip=station.get('lastip', ""), hostname=hostname)
+            if matched:
+                result.append((station, matched))
+
+        return result
@@ -1,7 +1,12 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import re
+import time
+import hashlib
+import threading
 from pywisp_emibcn.sshdevice import SSHDevice
+from pywisp_emibcn.profiling import profiler
 
 STATUS = {
     "bound": "online",
@@ -9,11 +14,123 @@ STATUS = {
 }
 
 
+class LeaseIndex():
+    '''DHCP leases from several routers, indexed by MAC and by hostname
+
+    Every lease gets the IP of the router it comes from under `router`.
+    Routers which failed are kept in `errors`, by router IP.
+    '''
+
+    def __init__(self):
+        self.leases = []
+        self.by_mac = {}
+        self.by_hostname = {}
+        self.errors = {}
+
+    def add(self, router, leases):
+        for lease in leases:
+            lease['router'] = router.ip
+            self.leases.append(lease)
+            if 'mac-address' in lease:
+                self.by_mac[lease['mac-address'].lower()] = lease
+            if 'host-name' in lease:
+                self.by_hostname.setdefault(
+                    lease['host-name'].lower(), []).append(lease)
+
+    def __len__(self):
+        return len(self.leases)
+
+
+class LeaseCache():
+    '''Per router snapshots of DHCP leases
+
+    A snapshot is answered locally for `ttl` seconds. Once expired, only the
+    leases seen since the last refresh are downloaded (filtering on their
+    `last-seen`) and merged by MAC. Every `full_ttl` seconds the whole table
+    is downloaded again, to forget removed and expired leases.
+    '''
+
+    ttl = 60
+    full_ttl = 900
+
+    # Time source, in seconds
+    clock = time.time
+
+    def __init__(self, ttl=None, full_ttl=None):
+        if ttl is not None:
+            self.ttl = ttl
+        if full_ttl is not None:
+            self.full_ttl = full_ttl
+        self.snapshots = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(lease):
+        return lease.get('mac-address', lease.get('address', lease.get('index')))
+
+    def refresh(self, router):
+        '''Get router's snapshot, refreshing it if needed'''
+        with self.lock:
+            lock = self.locks.setdefault(router.ip, threading.Lock())
+
+        with lock:
+            now = self.clock()
+            snapshot = self.snapshots.get(router.ip)
+
+            if snapshot is None or now - snapshot['full'] > self.full_ttl:
+                snapshot = {
+                    'leases': {self.key(lease): lease for lease in router.fetchDHCPLeases()},
+                    'updated': now,
+                    'full': now,
+                }
+                self.snapshots[router.ip] = snapshot
+
+            elif now - snapshot['updated'] > self.ttl:
+                age = int(now - snapshot['updated']) + 1
+                for lease in router.fetchDHCPLeases(' last-seen<{}s'.format(age)):
+                    snapshot['leases'][self.key(lease)] = lease
+                snapshot['updated'] = now
+
+            return snapshot
+
+    def get(self, router, name="", bound=None):
+        '''Cached leases, filtered as `MTDevice.getDHCPLeases` does on the router'''
+        leases = self.refresh(router)['leases'].values()
+
+        if name != "":
+            regex = re.compile(name)
+            leases = [lease for lease in leases
+                      if regex.search(lease.get('host-name', ""))]
+
+        if bound is not None:
+            leases = [lease for lease in leases
+                      if (lease.get('status') == 'bound') == bound]
+
+        return list(leases)
+
+    def invalidate(self, router=None):
+        '''Forget one router's snapshot, or all of them'''
+        with self.lock:
+            if router is None:
+                self.snapshots = {}
+            else:
+                self.snapshots.pop(router.ip, None)
+
+
 class MTDevice(SSHDevice):
     '''Mikrotik device class'''
 
     product = ""
-    data = {}
+    data = None
+    export = None
+    backup_format = 'export'
+
+    # Router which gave us this device's lease
+    router = None
+
+    # Class-wide LeaseCache, disabled by default
+    lease_cache = None
 
     def __init__(self, data, *args, **kwargs):
         '''Set specific Mikrotik values'''
@@ -26,22 +143,52 @@ class MTDevice(SSHDevice):
             kwargs['mac'] = data['mac-address']
         if 'status' in data:
             kwargs['status'] = STATUS[data['status']]
+        if 'router' in data:
+            self.router = data['router']
 
         # Save original data
         self.data = data
 
         super().__init__(*args, **kwargs)
 
-    def backup(self, path):
+    def getTargets(self):
+        '''SSH sessions to a device load the CCR it hangs from, too'''
+        targets = super().getTargets()
+        if self.router:
+            targets.append("ccr:{}".format(self.router))
+        return targets
+
+    def getExport(self):
+        '''Get config using MT export tool, reusing it if already downloaded'''
+        if self.export is None:
+            stdin, stdout, stderr = self.command("/export")
+            with profiler.phase('read', self.ip):
+                self.export = stdout.read()
+
+        return self.export
+
+    def getBackup(self):
         '''Backup Mikrotik device config'''
-        self.login()
+        return self.getExport()
+
+    def logout(self):
+        '''Forget downloaded export together with the session'''
+        self.export = None
+        super().logout()
 
-        # Use MT export tool
-        stdin, stdout, stderr = self.command("/export")
+    def getFingerprint(self):
+        '''Hash of the exported config, without its timestamp header
 
-        # Save stdout to backup file
-        with open(path + '/' + self.backup_file, "wb") as myfile:
-            myfile.write(stdout.read())
+        RouterOS has no checksum tool, so the export is downloaded and hashed
+        locally. It is kept for `getBackup`, so changed devices don't pay twice,
+        while unchanged ones don't rewrite their backup file.
+        '''
+        lines = [
+            line for line in self.getExport().splitlines()
+            if not line.startswith(b"#")
+        ]
+
+        return hashlib.sha1(b"\n".join(lines)).hexdigest()
 
     @staticmethod
     def parse_list(stdout):
@@ -107,9 +254,18 @@ class MTDevice(SSHDevice):
 
         self.name = stdout.readline().strip()
 
-    def getDHCPLeases(self, name="", bound=True):
+    def getDHCPLeases(self, name="", bound=True, cache=None):
+        '''Get DHCP leases, filtered by host-name regexp and (un)bound status
+
+        With a `LeaseCache` (by parameter or class-wide `lease_cache`), the
+        leases are answered from the router's cached snapshot.
+        '''
+
+        if cache is None:
+            cache = self.lease_cache
+        if cache:
+            return cache.get(self, name=name, bound=bound)
 
-        command = '/ip dhcp-server lease print detail without-paging'
         where = ""
 
         # Filter by host-name with a regexp
@@ -120,6 +276,13 @@ class MTDevice(SSHDevice):
         if bound is not None:
             where += ' status{}=bound'.format('' if bound else '!')
 
+        return self.fetchDHCPLeases(where)
+
+    def fetchDHCPLeases(self, where=""):
+        '''Download DHCP leases matching a `where` expression'''
+
+        command = '/ip dhcp-server lease print detail without-paging'
+
         # Add filters to command
         if where != "":
             command += ' where' + where
@@ -127,7 +290,8 @@ class MTDevice(SSHDevice):
         #stdin, stdout, stderr = self.command(":put \"" + command + "\"")
         stdin, stdout, stderr = self.command(command)
 
-        return self.parse_list(stdout)
+        with profiler.phase('read', self.ip):
+            return self.parse_list(stdout)
 
     def getWifiStatus(self):
         command = '/interface wireless registration-table print without-paging'
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+from pywisp_emibcn.store import JSONStore
+from pywisp_emibcn.parallel import parallel_map, default_scheduler
+
+
+class NameCache(JSONStore):
+    '''Devices names resolved over SSH, persisted by IP
+
+    Names older than `ttl` seconds are resolved again.
+    '''
+
+    ttl = 7 * 24 * 3600
+
+    def __init__(self, path=None, ttl=None):
+        if ttl is not None:
+            self.ttl = ttl
+        super().__init__(path)
+
+    def name(self, ip):
+        '''Cached name of an IP, or None if unknown or expired'''
+        entry = self.get(ip)
+        if entry and time.time() - entry['time'] < self.ttl:
+            return entry['name']
+        return None
+
+    def set_name(self, ip, name):
+        self[ip] = {'name': name, 'time': time.time()}
+
+
+def resolve_names(devices, workers=8, cache=None, scheduler=default_scheduler):
+    '''Resolve the names of devices without one, concurrently
+
+    Names are looked up first in `cache` (by default, the class-wide
+    `SSHDevice.name_cache`), and only the missing ones are asked to the
+    devices, which are disconnected afterwards. Returns a list of
+    (device, exception) tuples for the devices which could not be resolved.
+    '''
+    def resolve(device):
+        try:
+            return device.name
+        finally:
+            device.logout()
+
+    pending = []
+    for device in devices:
+        if cache is not None:
+            device.name_cache = cache
+        if not device.has_name():
+            pending.append(device)
+
+    results = parallel_map(resolve, pending,
+                           workers=workers, scheduler=scheduler)
+
+    for device in pending:
+        if device.name_cache is not None:
+            device.name_cache.save()
+            break
+
+    return [(device, error) for device, name, error in results if error is not None]
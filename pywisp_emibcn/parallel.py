@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TokenBucket():
+    '''Token bucket rate limiter: `rate` operations per second, with bursts of up to `burst`'''
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        '''Wait until a token is available, and take it'''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Scheduler():
+    '''Shared limits for concurrent operations against the infrastructure
+
+    Operations declare the targets they load, as `<kind>:<id>` strings (see
+    `SSHDevice.getTargets`): `host:10.1.1.1`, `br:1234`, `ccr:10.255.255.2`,
+    `controller:https://...`. A slot is given when there is room for all of
+    them: at most `workers` operations at once, at most `limits[kind]`
+    operations at once on the same target, and at most `rates[kind]`
+    operations per second started on the same target.
+    '''
+
+    workers = 16
+    limits = {
+        'host': 1,
+        'br': 4,
+        'ccr': 4,
+        'controller': 4,
+    }
+    rates = {}
+
+    def __init__(self, workers=None, limits=None, rates=None):
+        if workers is not None:
+            self.workers = workers
+        self.limits = dict(self.limits, **(limits or {}))
+        self.rates = dict(self.rates, **(rates or {}))
+
+        self.slots = threading.BoundedSemaphore(self.workers)
+        self.semaphores = {}
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        '''Create from a config section: `workers`, `limit.<kind>` and `rate.<kind>` keys'''
+        limits = {}
+        rates = {}
+        for name, value in config.items():
+            if name.startswith('limit.'):
+                limits[name[6:]] = int(value)
+            elif name.startswith('rate.'):
+                rates[name[5:]] = float(value)
+
+        workers = int(config['workers']) if 'workers' in config else None
+        return cls(workers=workers, limits=limits, rates=rates)
+
+    def target(self, target):
+        '''Semaphore and token bucket of a target, any of them may be None'''
+        kind = target.split(':', 1)[0]
+        with self.lock:
+            if kind in self.limits and target not in self.semaphores:
+                self.semaphores[target] = threading.BoundedSemaphore(
+                    self.limits[kind])
+            if kind in self.rates and target not in self.buckets:
+                self.buckets[target] = TokenBucket(self.rates[kind])
+
+        return self.semaphores.get(target), self.buckets.get(target)
+
+    @contextlib.contextmanager
+    def slot(self, *targets, globally=True):
+        '''Wait for room on every target and globally, and hold it while in context
+
+        Nested operations, already holding a global slot, must use `globally=False`.
+        '''
+
+        # Always acquire in the same order, so no one waits in a loop
+        targets = sorted(set(t for t in targets if t))
+        acquired = []
+        try:
+            for target in targets:
+                semaphore, bucket = self.target(target)
+                if semaphore is not None:
+                    semaphore.acquire()
+                    acquired.append(semaphore)
+
+            # Targets first, so busy targets don't hold global slots
+            if globally:
+                self.slots.acquire()
+                acquired.append(self.slots)
+
+            for target in targets:
+                semaphore, bucket = self.target(target)
+                if bucket is not None:
+                    bucket.acquire()
+
+            yield
+
+        finally:
+            for semaphore in reversed(acquired):
+                semaphore.release()
+
+
+# Scheduler shared by library operations, unless another one is given
+default_scheduler = Scheduler()
+
+
+def parallel_map(func, items, workers=8, scheduler=None, targets=None):
+    '''Run `func` on every item concurrently, using threads
+
+    Returns a list of (item, result, exception) tuples in the same order as
+    `items`. An exception on one item does not stop the others.
+
+    At most `workers` calls run at once. With a `scheduler`, every call
+    also waits for a slot on the targets returned by `targets(item)` (by
+    default, the item's `getTargets()`).
+    '''
+    items = list(items)
+    if not items:
+        return []
+
+    if scheduler is not None:
+        call = func
+        if targets is None:
+            def targets(item): return item.getTargets()
+
+        def func(item):
+            with scheduler.slot(*targets(item)):
+                return call(item)
+
+    results = []
+    with ThreadPoolExecutor(max_workers=min(workers, len(items))) as executor:
+        futures = [executor.submit(func, item) for item in items]
+        for item, future in zip(items, futures):
+            try:
+                results.append((item, future.result(), None))
+            except Exception as e:
+                results.append((item, None, e))
+
+    return results
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import gzip
+import hashlib
+import tarfile
+
+
+class InvalidBackup(Exception):
+    '''Downloaded backup is broken or incomplete'''
+
+
+def validate_backup(data, format=None):
+    '''Check a backup is complete, for known formats: `tar` or RouterOS `export`'''
+    if not data:
+        raise InvalidBackup("Empty backup")
+
+    if format == 'tar':
+        try:
+            with tarfile.open(fileobj=io.BytesIO(data), mode='r:') as tar:
+                members = 0
+                for member in tar:
+                    if member.isfile():
+                        tar.extractfile(member).read()
+                    members += 1
+        except (tarfile.TarError, EOFError) as e:
+            raise InvalidBackup("Broken tar: {}".format(e))
+        if not members:
+            raise InvalidBackup("Empty tar")
+
+    elif format == 'export':
+        text = data.decode('utf-8', errors='replace')
+        lines = text.rstrip().splitlines()
+        if not any(line.startswith('#') and 'by RouterOS' in line for line in lines[:5]):
+            raise InvalidBackup("No RouterOS export header")
+        if not any(line.startswith('/') for line in lines):
+            raise InvalidBackup("No RouterOS export sections")
+        if not text.endswith('\n') or lines[-1].endswith('\\'):
+            raise InvalidBackup("Truncated RouterOS export")
+
+
+def process_backup(data, file, format=None, compress=False):
+    '''CPU stage of a backup, run in a worker process
+
+    Validates the backup, optionally gzips it and writes it atomically to
+    `file`. Returns the written file SHA-256 and size.
+    '''
+    validate_backup(data, format)
+
+    if compress:
+        data = gzip.compress(data, mtime=0)
+
+    with open(file + ".part", "wb") as f:
+        f.write(data)
+    os.replace(file + ".part", file)
+
+    return hashlib.sha256(data).hexdigest(), len(data)
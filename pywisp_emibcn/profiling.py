@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import io
+import json
+import time
+import pstats
+import cProfile
+import threading
+import contextlib
+
+
+class Profiler():
+    '''CPU profile plus wall-clock timings of the instrumented I/O phases
+
+    Phases (`connect`, `auth`, `exec`, `read`, `http`, `parse`) are recorded
+    from any thread, with the device they work on, while the profiler is
+    started. Otherwise `phase` costs nothing.
+    '''
+
+    enabled = False
+
+    def __init__(self):
+        self.phases = []
+        self.lock = threading.Lock()
+        self.cpu = None
+        self.started = None
+        self.stopped = None
+
+    def start(self):
+        self.phases = []
+        self.started = time.perf_counter()
+        self.cpu = cProfile.Profile()
+        self.cpu.enable()
+        self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+        self.cpu.disable()
+        self.stopped = time.perf_counter()
+
+    def phase(self, name, target=None):
+        '''Context recording the wall-clock time spent in a phase'''
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self.record(name, target)
+
+    @contextlib.contextmanager
+    def record(self, name, target=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self.lock:
+                self.phases.append(
+                    (name, target, threading.current_thread().name, start, end))
+
+    def totals(self):
+        '''{phase: (count, seconds)}'''
+        totals = {}
+        for name, target, thread, start, end in self.phases:
+            count, seconds = totals.get(name, (0, 0.0))
+            totals[name] = (count + 1, seconds + end - start)
+        return totals
+
+    def slowest(self, top=10):
+        '''Top devices by wall-clock time in phases: [(device, seconds, {phase: seconds})]'''
+        devices = {}
+        for name, target, thread, start, end in self.phases:
+            if target is None:
+                continue
+            phases = devices.setdefault(target, {})
+            phases[name] = phases.get(name, 0.0) + end - start
+
+        result = [(target, sum(phases.values()), phases)
+                  for target, phases in devices.items()]
+        result.sort(key=lambda device: device[1], reverse=True)
+        return result[:top]
+
+    def speedscope(self, name="pywisp"):
+        '''Phases as a speedscope evented profile, one per thread'''
+        frames = []
+        frame_ids = {}
+        threads = {}
+        for phase, target, thread, start, end in self.phases:
+            if phase not in frame_ids:
+                frame_ids[phase] = len(frames)
+                frames.append({'name': phase})
+            threads.setdefault(thread, []).append(
+                (start - self.started, end - self.started, frame_ids[phase]))
+
+        profiles = []
+        for thread, phases in sorted(threads.items()):
+            events = []
+            for start, end, frame in phases:
+                events.append((start, 1, -end, {'type': 'O', 'frame': frame, 'at': start}))
+                events.append((end, 0, -start, {'type': 'C', 'frame': frame, 'at': end}))
+            # Close before opening at the same time, outer phases around inner ones
+            events.sort(key=lambda event: event[:3])
+            profiles.append({
+                'type': 'evented',
+                'name': thread,
+                'unit': 'seconds',
+                'startValue': 0,
+                'endValue': self.stopped - self.started,
+                'events': [event[3] for event in events],
+            })
+
+        return {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'name': name,
+            'shared': {'frames': frames},
+            'profiles': profiles,
+        }
+
+    def write(self, prefix):
+        '''Write `<prefix>.prof` (cProfile) and `<prefix>.speedscope.json`'''
+        self.cpu.dump_stats(prefix + ".prof")
+        with open(prefix + ".speedscope.json", "w") as f:
+            json.dump(self.speedscope(), f)
+
+    def report(self, top=10):
+        '''Text report: phases totals, slowest devices and CPU hotspots'''
+        out = io.StringIO()
+        out.write(u"Wall time: {:.3f}s\n\n".format(self.stopped - self.started))
+
+        out.write(u"{:<10} {:>8} {:>10}\n".format("Phase", "Count", "Seconds"))
+        for name, (count, seconds) in sorted(self.totals().items(), key=lambda t: -t[1][1]):
+            out.write(u"{:<10} {:>8} {:>10.3f}\n".format(name, count, seconds))
+
+        slowest = self.slowest(top)
+        if slowest:
+            out.write(u"\n{:<20} {:>10}  {}\n".format("Device", "Seconds", "Phases"))
+            for target, seconds, phases in slowest:
+                out.write(u"{:<20} {:>10.3f}  {}\n".format(target, seconds, ", ".join(
+                    "{} {:.3f}".format(name, s) for name, s in sorted(phases.items()))))
+
+        out.write(u"\n")
+        stats = pstats.Stats(self.cpu, stream=out)
+        stats.sort_stats('cumulative').print_stats(top)
+
+        return out.getvalue()
+
+
+# Profiler shared by all instrumented code
+profiler = Profiler()
@@ -2,8 +2,11 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import atexit
 import configparser
 import os
+import sys
+import json
 import pkgutil
 import logging
 from importlib import import_module
@@ -11,7 +14,15 @@ from pprint import pprint
 
 # Internal imports
 from pywisp_emibcn.wisp import Wisp
-from pywisp_emibcn.sshdevice import backup_devices
+from pywisp_emibcn.sshdevice import SSHDevice, backup_devices, print_jsonl
+from pywisp_emibcn.names import NameCache, resolve_names
+from pywisp_emibcn.location import LocationIndex
+from pywisp_emibcn.aircontrol import ACDevice
+from pywisp_emibcn.profiling import profiler
+from pywisp_emibcn.archive import ArchiveIndex
+from pywisp_emibcn.audit import Audit
+from pywisp_emibcn.health import HostHealth
+from pywisp_emibcn.parallel import Scheduler, parallel_map
 
 
 class PyWisp():
@@ -63,35 +74,123 @@ class PyWisp():
 
         return log
 
+    def setup_cache(self):
+        '''Persistent caches, configured in the [cache] section
+
+        Not set up by default, so library use doesn't write to the home
+        directory: `main` sets them up for the command line.
+        '''
+        cache = self.config['cache'] if self.config and 'cache' in self.config else {}
+        path = os.path.expanduser(cache.get('path', '~/.cache/pywisp'))
+        ttl = float(cache['names_ttl']) if 'names_ttl' in cache else None
+
+        SSHDevice.name_cache = NameCache(
+            os.path.join(path, "names.json"), ttl=ttl)
+        atexit.register(SSHDevice.name_cache.save)
+
+        ACDevice.location_index = LocationIndex(
+            os.path.join(path, "locations.json"))
+        atexit.register(ACDevice.location_index.save)
+
     def parse_device(self, device):
         '''Parses a device using arguments passed to program'''
 
+        self.print_device(device, self.device_results(device))
+
+        if 'ssh' in self.args and self.args.ssh:
+            device.shell()
+
+    def parse_devices(self, devices, workers=8):
+        '''Parses several devices concurrently, printing them in order. Returns the failed ones
+
+        AirControl WebUI URLs of all devices are asked in a single request.
+        SSH shells are opened one by one, afterwards.
+        '''
+
+        urls = None
+        if 'url' in self.args and self.args.url:
+            # Looked up by key: devices without URL are left out
+            urls = self.wisp.ac.getDevicesURL(
+                [device.key for device in devices if hasattr(device, 'key')])
+
+        def parse(device):
+            try:
+                return self.device_results(device, urls=urls)
+            finally:
+                if not ('ssh' in self.args and self.args.ssh):
+                    device.logout()
+
+        failed = []
+        for device, results, error in parallel_map(parse, devices, workers=workers,
+                                                   scheduler=self.wisp.scheduler):
+            if error is not None:
+                failed.append(device)
+                self.log.error("%s: %s" % (device.ip, error))
+                if getattr(self.args, 'format', 'text') == 'jsonl':
+                    print_jsonl({'host': device.ip, 'error': type(error).__name__,
+                                 'message': str(error)})
+                continue
+            self.print_device(device, results)
+
+        if 'ssh' in self.args and self.args.ssh:
+            for device in devices:
+                if device not in failed:
+                    device.shell()
+
+        return failed
+
+    def device_results(self, device, urls=None):
+        '''Results of the actions passed to program on a device, as a dict
+
+        `urls` are the already known WebUI URLs, by device key.
+        '''
+
+        results = {}
         if 'getname' in self.args and self.args.getname:
-            print(device.name)
+            results['name'] = device.name
         if 'getid' in self.args and self.args.getid:
-            print(device.id)
+            results['id'] = device.id
         if 'getip' in self.args and self.args.getip:
-            print(device.ip)
+            results['ip'] = device.ip
         if 'getmac' in self.args and self.args.getmac:
-            print(device.mac)
+            results['mac'] = device.mac
         if 'getstatus' in self.args and self.args.getstatus:
-            print(device.status)
+            results['status'] = device.status
         if 'getdhcp' in self.args and self.args.getdhcp:
-            pprint(device.getDHCPLeases(bound=None))
+            results['dhcp'] = device.getDHCPLeases(bound=None)
         if 'getwifi' in self.args and self.args.getwifi:
-            pprint(device.getWifiStatus())
+            results['wifi'] = device.getWifiStatus()
         if 'getwifistations' in self.args and self.args.getwifistations:
-            pprint(device.getWifiStations())
+            results['wifistations'] = device.getWifiStations()
         if 'getjson' in self.args and self.args.getjson:
-            pprint(device.data)
+            results['json'] = device.data
         if 'url' in self.args and self.args.url:
-            print(self.wisp.ac.getDevicesURL([device.id])[0]['url'])
+            if urls is None:
+                urls = self.wisp.ac.getDevicesURL([device.key])
+            if urls.get(device.key) is None:
+                raise Exception(u'No WebUI URL for {}'.format(device.key))
+            results['url'] = urls[device.key]
         if 'cmd' in self.args and self.args.cmd:
-            stdin, stdout, stderr = device.command(args.cmd)
-            print(stdout.read().decode(), end="")
-            print(stderr.read().decode(), end="")
-        if 'ssh' in self.args and self.args.ssh:
-            device.shell()
+            stdin, stdout, stderr = device.command(self.args.cmd)
+            results['stdout'] = stdout.read().decode()
+            results['stderr'] = stderr.read().decode()
+
+        return results
+
+    def print_device(self, device, results):
+        '''Prints device results using the output format passed to program'''
+
+        if getattr(self.args, 'format', 'text') == 'jsonl':
+            print_jsonl(dict(host=device.ip, **results))
+            return
+
+        for key, value in results.items():
+            if key in ('dhcp', 'wifi', 'wifistations', 'json'):
+                pprint(value)
+            elif key in ('stdout', 'stderr'):
+                print(value, end="")
+            else:
+                print(value)
 
     def parse_arguments(self, parser=argparse.ArgumentParser(formatter_class=MyCustomFormatter)):
         '''Parses arguments passed to program into a dict'''
@@ -100,6 +199,13 @@ class PyWisp():
                             default="{}/{}".format(os.getenv('HOME'),
                                                    '.pywisp'),
                             help="Reads configuration from this file instead of default")
+        parser.add_argument("--format", type=str, choices=["text", "jsonl"],
+                            default="text",
+                            help="Output format: human readable text or one JSON object per line")
+        parser.add_argument("--profile", type=str, metavar="PREFIX",
+                            help="Profile the command: writes PREFIX.prof (cProfile) and PREFIX.speedscope.json (I/O phases), and prints a summary")
+        parser.add_argument("--profile-top", type=int, default=10, metavar="N",
+                            help="Slowest devices and functions shown in the profile summary")
 
         sp = parser.add_subparsers()
 
@@ -110,6 +216,24 @@ class PyWisp():
         b_ac.add_argument("--retries",
                           action="store_true", default=3,
                           help="Retries for every device before stop trying")
+        b_ac.add_argument("--no-prescan", dest="prescan",
+                          action="store_false",
+                          help="Don't pre-scan devices for an open SSH port before backing them up")
+        b_ac.add_argument("--prescan-timeout", type=float, default=1.0,
+                          help="Seconds to wait for every device's SSH port on the pre-scan")
+        b_ac.add_argument("--incremental",
+                          action="store_true",
+                          help="Only download backups of devices whose config fingerprint changed")
+        b_ac.add_argument("--resume",
+                          action="store_true",
+                          help="Continue the last interrupted backup run from its journal")
+        b_ac.add_argument("--compress",
+                          action="store_true",
+                          help="Save backups gzipped")
+        b_ac.add_argument("--workers", type=int, default=8,
+                          help="Devices downloaded at once")
+        b_ac.add_argument("--processes", type=int, default=None,
+                          help="Processes validating and saving backups (default: CPUs count)")
 
         b_mt = sp.add_parser("backup_mt", formatter_class=self.MyCustomFormatter,
                              help="Backup all Mikrotik devices")
@@ -118,9 +242,60 @@ class PyWisp():
         b_mt.add_argument("--retries",
                           action="store_true", default=3,
                           help="Retries for every device before stop trying")
+        b_mt.add_argument("--no-prescan", dest="prescan",
+                          action="store_false",
+                          help="Don't pre-scan devices for an open SSH port before backing them up")
+        b_mt.add_argument("--prescan-timeout", type=float, default=1.0,
+                          help="Seconds to wait for every device's SSH port on the pre-scan")
+        b_mt.add_argument("--incremental",
+                          action="store_true",
+                          help="Only download backups of devices whose config fingerprint changed")
+        b_mt.add_argument("--resume",
+                          action="store_true",
+                          help="Continue the last interrupted backup run from its journal")
+        b_mt.add_argument("--compress",
+                          action="store_true",
+                          help="Save backups gzipped")
+        b_mt.add_argument("--workers", type=int, default=8,
+                          help="Devices downloaded at once")
+        b_mt.add_argument("--processes", type=int, default=None,
+                          help="Processes validating and saving backups (default: CPUs count)")
 
         reorder = sp.add_parser("reorder_ac", formatter_class=self.MyCustomFormatter,
                                 help="Reorder branches from AirControl devices")
+        reorder.set_defaults(reorder_ac=True)
+
+        sweep = sp.add_parser("sweep_ac", formatter_class=self.MyCustomFormatter,
+                              help="Update clients location index from all BRs station lists")
+        sweep.add_argument("--from-br", type=str,
+                           help="Sweep only this BR")
+        sweep.set_defaults(sweep_ac=True)
+
+        search = sp.add_parser("search", formatter_class=self.MyCustomFormatter,
+                               help="Find backups whose config contains a text")
+        search.add_argument("term", type=str,
+                            help="Text to find (SSID, VLAN, firewall rule, ...)")
+        search.add_argument("--path", type=str, action="append",
+                            help="Backups directory to search (default: configured AC and MT backups directories)")
+        search.add_argument("--device", type=str,
+                            help="Search only this device backups")
+        search.add_argument("--latest",
+                            action="store_true",
+                            help="Search only every device's latest backup")
+        search.add_argument("--limit", type=int,
+                            help="Maximum number of backups found")
+
+        audit = sp.add_parser("audit", formatter_class=self.MyCustomFormatter,
+                              help="Check backups configs against a rules file")
+        audit.add_argument("rules", type=str,
+                           help="JSON file with the list of rules")
+        audit.add_argument("--path", type=str, action="append",
+                           help="Backups directory to audit (default: configured AC and MT backups directories)")
+        audit.add_argument("--all",
+                           action="store_true",
+                           help="Audit every backup, not only every device's latest one")
+        audit.add_argument("--processes", type=int, default=None,
+                           help="Processes parsing and auditing backups (default: CPUs count)")
 
         host_parser = sp.add_parser("host", formatter_class=self.MyCustomFormatter,
                                     help="Find device by it's hostname, MAC or IP")
@@ -132,6 +307,13 @@ class PyWisp():
                                  help="Find device by it's hostname, MAC or IP, using all BRs station list as haystack")
         host_parser.add_argument("--from-br", type=str,
                                  help="Deep find only in this BR")
+        host_parser.add_argument("--no-index",
+                                 action="store_false",
+                                 dest="index",
+                                 help="Deep find asking all BRs, instead of where clients were seen last")
+        host_parser.add_argument("--subtree",
+                                 action="store_true",
+                                 help="Act on all devices hanging from the found ones in AirControl topology, instead")
 
         host_parser.add_argument("--getname",
                                  action="store_true",
@@ -203,6 +385,25 @@ class PyWisp():
                 self.log.debug("Loaded AC configuration:  %s",
                                wisp_conf['ac_conf'])
 
+            # Several AirControl servers: [ac:<name>] sections
+            federation = {
+                section.split(':', 1)[1]: {
+                    name: value for name, value in config.items(section)}
+                for section in config.sections() if section.startswith('ac:')
+            }
+            if federation:
+                if wisp_conf['ac_conf']:
+                    federation = dict(ac=wisp_conf['ac_conf'], **federation)
+                wisp_conf['ac_conf'] = federation
+                self.log.debug("Loaded AC federation: %s",
+                               ", ".join(federation))
+
+            if 'scheduler' in config:
+                wisp_conf['scheduler'] = Scheduler.from_config(
+                    dict(config.items('scheduler')))
+                self.log.debug("Loaded scheduler configuration: %s",
+                               dict(config.items('scheduler')))
+
             if 'wisp' in config:
                 self.log.debug("Detected extra class for managing wisp.")
 
@@ -237,6 +438,38 @@ class PyWisp():
 def main():
 
     pywisp = PyWisp()
+    pywisp.setup_cache()
+
+    if not pywisp.args.profile:
+        return run(pywisp)
+
+    profiler.start()
+    try:
+        return run(pywisp)
+    finally:
+        profiler.stop()
+        profiler.write(pywisp.args.profile)
+        sys.stderr.write(profiler.report(top=pywisp.args.profile_top))
+
+
+def backup_paths(pywisp):
+    '''Backups directories passed to program, or configured ones'''
+    paths = pywisp.args.path
+    if not paths and 'backup' in pywisp.config:
+        paths = [pywisp.config['backup'][kind]
+                 for kind in ('ac', 'mt') if kind in pywisp.config['backup']]
+    return paths
+
+
+def index_backups(pywisp, path):
+    '''Update the search index of a backups directory'''
+    index = ArchiveIndex(path)
+    pywisp.log.debug("Indexed %d new backups in %s" % (index.update(), path))
+    return index
+
+
+def run(pywisp):
+    '''Run the command passed to program'''
 
     # Backup everything!
     if 'backup_ac_path' in pywisp.args:
@@ -249,7 +482,17 @@ def main():
             retries = pywisp.config['backup']['retries']
 
         pywisp.log.debug('Backup AC devices to %s' % (path))
-        backup_devices(pywisp.wisp.get_ac_devices(), path, retries=retries)
+        backup_devices(pywisp.wisp.get_ac_devices(), path,
+                       retries=retries, output=pywisp.args.format,
+                       health=HostHealth(os.path.join(path, ".health.json")),
+                       prescan=pywisp.args.prescan,
+                       prescan_timeout=pywisp.args.prescan_timeout,
+                       incremental=pywisp.args.incremental,
+                       journal=True, resume=pywisp.args.resume,
+                       workers=pywisp.args.workers, processes=pywisp.args.processes,
+                       compress=pywisp.args.compress,
+                       scheduler=pywisp.wisp.scheduler)
+        index_backups(pywisp, path).close()
 
     elif 'backup_mt_path' in pywisp.args:
         path = pywisp.args.backup_mt_path
@@ -261,15 +504,87 @@ def main():
             retries = pywisp.config['backup']['retries']
 
         pywisp.log.debug('Backup MT devices to %s' % (path))
-        backup_devices(pywisp.wisp.get_mt_devices(), path, retries=retries)
+        backup_devices(pywisp.wisp.get_mt_devices(), path,
+                       retries=retries, output=pywisp.args.format,
+                       health=HostHealth(os.path.join(path, ".health.json")),
+                       prescan=pywisp.args.prescan,
+                       prescan_timeout=pywisp.args.prescan_timeout,
+                       incremental=pywisp.args.incremental,
+                       journal=True, resume=pywisp.args.resume,
+                       workers=pywisp.args.workers, processes=pywisp.args.processes,
+                       compress=pywisp.args.compress,
+                       scheduler=pywisp.wisp.scheduler)
+        index_backups(pywisp, path).close()
+
+    # Search backups contents
+    elif 'term' in pywisp.args:
+        paths = backup_paths(pywisp)
+        if not paths:
+            pywisp.log.error("No backups directory to search")
+            return 1
+
+        found = 0
+        for path in paths:
+            index = index_backups(pywisp, path)
+            results = index.search(pywisp.args.term, device=pywisp.args.device,
+                                   latest=pywisp.args.latest, limit=pywisp.args.limit)
+            index.close()
+
+            for result in results:
+                found += 1
+                if pywisp.args.format == 'jsonl':
+                    print_jsonl(result)
+                    continue
+                print(u"{device} {date} {file} ({member})".format(**result))
+                for line in result['lines']:
+                    print(u"    " + line)
+
+        if not found:
+            return 1
+
+    # Audit backups configs
+    elif 'rules' in pywisp.args:
+        paths = backup_paths(pywisp)
+        if not paths:
+            pywisp.log.error("No backups directory to audit")
+            return 1
+
+        with open(pywisp.args.rules) as f:
+            rules = json.load(f)
+
+        failed = 0
+        for path in paths:
+            audit = Audit(path, processes=pywisp.args.processes)
+            for result in audit.run(rules, latest=not pywisp.args.all):
+                if not result['violations']:
+                    continue
+                failed += 1
+                if pywisp.args.format == 'jsonl':
+                    print_jsonl(result)
+                    continue
+                print(u"{device} {date} {file}".format(**result))
+                for violation in result['violations']:
+                    print(u"    [{rule}] {key} = {value} {message}".format(**dict(
+                        violation, value="(missing)" if violation['value'] is None else violation['value'])))
+            audit.close()
+
+        if failed:
+            return 1
 
     # Reorder AirControl branches
     elif 'reorder_ac' in pywisp.args:
         pywisp.log.debug('Reorder branches!')
         pywisp.wisp.ac_reorder_branches()
 
+    # Update clients location index
+    elif 'sweep_ac' in pywisp.args:
+        clients = pywisp.wisp.sweep_locations(from_br=pywisp.args.from_br)
+        pywisp.log.info("Clients located: %d" % (len(clients)))
+
     # Find host and print info about it or perform actions on it
     elif 'host' in pywisp.args:
+        pywisp.wisp.use_location_index = pywisp.args.index
+
         # Optional lower host (insensitive)
         pywisp.args.host = pywisp.args.host.lower().strip()
 
@@ -284,9 +599,22 @@ def main():
         if type(devices) is not list:
             devices = [devices]
 
-        # Apply actions for every device found
-        for device in devices:
-            pywisp.parse_device(device)
+        # Replace found devices with their topology subtrees
+        if pywisp.args.subtree:
+            devices = pywisp.wisp.get_subtree(
+                [device for device in devices if hasattr(device, 'key')])
+
+        # Apply actions for every device found, concurrently if several
+        if len(devices) == 1:
+            pywisp.parse_device(devices[0])
+            return 0
+
+        # Names of IP-only devices, concurrently and from the names cache
+        for device, error in resolve_names(devices, scheduler=pywisp.wisp.scheduler):
+            pywisp.log.debug("Could not resolve name of %s: %s" % (device.ip, error))
+
+        if pywisp.parse_devices(devices):
+            return 1
 
     return 0
 
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import ipaddress
+
+
+def mac2int(mac):
+    return int(mac.replace(':', '').replace('-', ''), 16)
+
+
+def int2mac(mac):
+    mac = "{:012x}".format(mac)
+    return ":".join(mac[i:i + 2] for i in range(0, 12, 2))
+
+
+class DeviceRecord():
+    '''Compact device representation for whole-fleet operations
+
+    Uses `__slots__` instead of a per-instance `__dict__`, stores IP and MAC
+    as integers and does not keep the original JSON: `data` is only loaded,
+    using `loader`, when first needed.
+    '''
+
+    __slots__ = ('id', 'ip', 'mac', 'name', 'status', 'parent',
+                 'ssid', 'product', 'mode', 'controller', 'loader', '_data')
+
+    def __init__(self, id=-1, ip=None, mac=None, name="", status="", parent=None,
+                 ssid="", product="", mode="", controller=None, loader=None):
+        self.id = id
+        self.ip = ip
+        self.mac = mac
+        self.name = name
+        self.status = status
+        self.parent = parent
+        self.ssid = ssid
+        self.product = product
+        self.mode = mode
+        self.controller = controller
+        self.loader = loader
+        self._data = None
+
+    @property
+    def key(self):
+        '''Key in its AirControl inventory: (controller, id) on federations'''
+        if self.controller is not None:
+            return self.controller, self.id
+        return self.id
+
+    @property
+    def parent_key(self):
+        if self.controller is not None and self.parent is not None:
+            return self.controller, self.parent
+        return self.parent
+
+    @property
+    def ip_address(self):
+        return str(ipaddress.IPv4Address(self.ip)) if self.ip is not None else ""
+
+    @property
+    def mac_address(self):
+        return int2mac(self.mac) if self.mac is not None else ""
+
+    @property
+    def data(self):
+        '''Full original data, lazily loaded'''
+        if self._data is None and self.loader:
+            self._data = self.loader(self)
+        return self._data
+
+    @classmethod
+    def from_aircontrol(cls, json, loader=None, status=None):
+        '''Create a record from an AirControl device JSON'''
+        properties = json.get('properties', {})
+
+        ip = properties.get('ip')
+        if isinstance(ip, str):
+            ip = int(ipaddress.IPv4Address(ip))
+
+        mac = properties.get('mac')
+        state = properties.get('status', "")
+        if status and state in range(len(status)):
+            state = status[state]
+
+        return cls(
+            id=json.get('deviceId', -1),
+            ip=ip,
+            mac=mac2int(mac) if mac else None,
+            name=properties.get('hostname', ""),
+            status=state,
+            parent=json.get('parentId'),
+            ssid=properties.get('essid', ""),
+            product=properties.get('product', ""),
+            mode=properties.get('wlanOpModeString', ""),
+            controller=json.get('controller'),
+            loader=loader)
+
+    def __repr__(self):
+        return u"<{} {} : {} - {}>".format(
+            type(self).__name__, self.name, self.mac_address, self.ip_address)
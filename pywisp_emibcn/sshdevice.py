@@ -1,17 +1,34 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import io
+import hashlib
 import datetime
 import paramiko
 import base64
 import os
+import shutil
 import socket
+import sys
+import time
+import json
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 from termcolor import colored
 from pprint import pprint
 try:
     import interactive
 except ImportError:
     from . import interactive
+from pywisp_emibcn.health import tcp_scan
+from pywisp_emibcn.store import JSONStore
+from pywisp_emibcn.journal import BackupJournal
+from pywisp_emibcn.names import resolve_names
+from pywisp_emibcn.parallel import parallel_map, TokenBucket, default_scheduler
+from pywisp_emibcn.pipeline import InvalidBackup, process_backup
+from pywisp_emibcn.profiling import profiler
 
 
 class SSHDevice:
@@ -24,6 +41,27 @@ class SSHDevice:
     rsa = ""
     status = ""
     backup_file_base = ""
+    warning = ""
+
+    # Backup contents format, to validate it: 'tar', 'export' or None
+    backup_format = None
+
+    # SSH connect/auth timeout, and last observed login latency
+    timeout = 5
+    latency = None
+
+    # Commands and transfers read timeout: slow commands (exports, tars)
+    # may take a while before any output, regardless of login latency
+    command_timeout = 30
+
+    # Known to be unreachable: don't retry it
+    unreachable = False
+
+    # Fastest file transfer method of every device, by IP
+    transfer_methods = {}
+
+    # Persistent names cache (a `NameCache`), shared by all devices
+    name_cache = None
 
     client = False
 
@@ -32,18 +70,21 @@ class SSHDevice:
         # Set minimal device data
         self.ip = ip
         self.mac = mac
+        self.backup_file_base = backup_file
         self.name = name
         self.username = username
         self.password = password
         self.rsa = rsa
         self.status = status
-        self.backup_file_base = backup_file
 
     # Use setters anf getters for properties needing expensive actions
     @property
     def name(self):
         if not self.__name or self.__name == "":
-            self.getName()
+            if not self.has_name():
+                self.getName()
+                if self.name_cache is not None and self.__name:
+                    self.name_cache.set_name(self.ip, self.__name)
         return self.__name
 
     @name.setter
@@ -65,6 +106,18 @@ class SSHDevice:
     def getName(self):
         raise NotImplementedError("Should have implemented `getName` method")
 
+    def has_name(self):
+        '''Is the name known without asking the device? Takes it from the names cache, if there'''
+        if not self.__name and self.name_cache is not None:
+            name = self.name_cache.name(self.ip)
+            if name:
+                self.name = name
+        return bool(self.__name)
+
+    def getTargets(self):
+        '''Infrastructure loaded when working on this device, for `Scheduler` limits'''
+        return ["host:{}".format(self.ip)]
+
     def setBackupName(self, backup_file=""):
         '''Set backup filename'''
 
@@ -79,6 +132,259 @@ class SSHDevice:
         else:
             self.backup_file = self.backup_file_base
 
+    def getBackup(self):
+        raise NotImplementedError("Should have implemented `getBackup` method")
+
+    def getFingerprint(self):
+        '''Cheap config fingerprint, or None if the device can't give one'''
+        return None
+
+    def backup(self, path, fingerprints=None):
+        '''Backup device config into `path`
+
+        With a `fingerprints` store, ask the device for a cheap fingerprint
+        first, and only download the full backup if it differs from the last
+        stored one. Returns False when the last backup has been reused.
+        '''
+        data, fingerprint = self.fetchBackup(path, fingerprints=fingerprints)
+        if data is None:
+            return False
+
+        self.storeBackup(path, data, fingerprint=fingerprint, fingerprints=fingerprints)
+        return True
+
+    def fetchBackup(self, path, fingerprints=None):
+        '''Network part of `backup`: returns (data, fingerprint)
+
+        Data is None when the last backup has been reused.
+        '''
+        self.login()
+
+        file = os.path.join(path, self.backup_file)
+        fingerprint = None
+        if fingerprints is not None:
+            fingerprint = self.getFingerprint()
+            last = fingerprints.get(self.ip)
+            if fingerprint and last and last['fingerprint'] == fingerprint:
+                previous = os.path.join(path, last['file'])
+                if os.path.isfile(previous) and os.stat(previous).st_size > 0:
+                    if previous != file:
+                        link_file(previous, file)
+                    fingerprints[self.ip] = {
+                        'fingerprint': fingerprint, 'file': self.backup_file}
+                    return None, fingerprint
+
+        return self.getBackup(), fingerprint
+
+    def storeBackup(self, path, data, fingerprint=None, fingerprints=None):
+        '''Write backup data into `path`, and remember its fingerprint'''
+        file = os.path.join(path, self.backup_file)
+
+        # Write to a temporary file and rename it, so no partial file is left
+        with open(file + ".part", "wb") as myfile:
+            myfile.write(data)
+        os.replace(file + ".part", file)
+
+        self.saveFingerprint(fingerprint, fingerprints)
+
+    def saveFingerprint(self, fingerprint, fingerprints):
+        if fingerprint and fingerprints is not None:
+            fingerprints[self.ip] = {
+                'fingerprint': fingerprint, 'file': self.backup_file}
+
+    def getTransferMethod(self):
+        '''Fastest file transfer available on the device: 'sftp', 'scp' or 'exec'
+
+        Detected once per device IP, and cached for later connections.
+        '''
+        method = SSHDevice.transfer_methods.get(self.ip)
+        if method is None:
+            method = self.detectTransferMethod()
+            SSHDevice.transfer_methods[self.ip] = method
+        return method
+
+    def detectTransferMethod(self):
+        self.login()
+
+        try:
+            self.client.open_sftp().close()
+            return 'sftp'
+        except Exception:
+            pass
+
+        stdin, stdout, stderr = self.command('command -v scp')
+        if stdout.read().strip():
+            return 'scp'
+
+        return 'exec'
+
+    def getFiles(self, files):
+        '''Download remote files, using the fastest transfer method available
+
+        Returns a {path: contents} dict. Missing files are left out, and
+        any other read error is raised.
+        '''
+        self.login()
+
+        method = self.getTransferMethod()
+        with profiler.phase('read', self.ip):
+            return self.receiveFiles(files, method)
+
+    def receiveFiles(self, files, method):
+        if method == 'sftp':
+            return self.sftpReceive(files)
+        if method == 'scp':
+            return self.scpReceive(files)
+
+        result = {}
+        for file in files:
+            stdin, stdout, stderr = self.command('cat "{}"'.format(file))
+            data = stdout.read()
+            if stdout.channel.recv_exit_status() == 0:
+                result[file] = data
+                continue
+
+            error = stderr.read().decode().strip()
+            if "No such file" not in error:
+                raise Exception(u'Reading {} failed: {}'.format(file, error))
+        return result
+
+    def sftpReceive(self, files):
+        '''Download files using SFTP, with pipelined reads'''
+        result = {}
+        sftp = self.client.open_sftp()
+        try:
+            for file in files:
+                try:
+                    with sftp.open(file, 'rb') as f:
+                        f.prefetch()
+                        result[file] = f.read()
+                except FileNotFoundError:
+                    continue
+        finally:
+            sftp.close()
+
+        return result
+
+    def scpReceive(self, files):
+        '''Download files using SCP source mode on the device (`scp -f`)'''
+        chan = self.client.get_transport().open_session(timeout=self.timeout)
+        chan.settimeout(self.command_timeout)
+        chan.exec_command(
+            'scp -f {}'.format(" ".join('"{}"'.format(f) for f in files)))
+        stream = chan.makefile('rb')
+
+        # SCP sends files in the requested order. Errors are sent as lines
+        # starting with 0x01 (warning, like missing files) or 0x02 (fatal).
+        # Only missing files are skipped
+        result = {}
+        remaining = list(files)
+        try:
+            chan.sendall(b'\0')
+            while True:
+                line = stream.readline()
+                if not line:
+                    break
+                if line[:1] in (b'\x01', b'\x02'):
+                    if line[:1] == b'\x02' or b'No such file' not in line:
+                        raise Exception(u'SCP read failed: {}'.format(
+                            line[1:].decode(errors='replace').strip()))
+                    if remaining:
+                        remaining.pop(0)
+                    continue
+                if line[:1] == b'T':
+                    chan.sendall(b'\0')
+                    continue
+                if line[:1] != b'C':
+                    raise Exception(
+                        u'Unexpected SCP response: {}'.format(line[:80]))
+
+                mode, size, name = line[1:].decode().rstrip('\n').split(' ', 2)
+                chan.sendall(b'\0')
+                data = stream.read(int(size) + 1)
+                result[remaining.pop(0) if remaining else name] = data[:-1]
+                chan.sendall(b'\0')
+        finally:
+            chan.close()
+
+        return result
+
+    def putFile(self, path, data, mode=0o644):
+        '''Upload contents to a remote file, using the fastest transfer method available'''
+        self.login()
+
+        method = self.getTransferMethod()
+        if method == 'sftp':
+            sftp = self.client.open_sftp()
+            try:
+                sftp.putfo(io.BytesIO(data), path)
+                sftp.chmod(path, mode)
+            finally:
+                sftp.close()
+
+        elif method == 'scp':
+            self.scpSend(path, data, mode)
+
+        else:
+            stdin, stdout, stderr = self.command(
+                'cat > "{path}" && chmod {mode:o} "{path}"'.format(path=path, mode=mode))
+            stdin.write(data)
+            stdin.channel.shutdown_write()
+            if stdout.channel.recv_exit_status() != 0:
+                raise Exception(u'Upload to {} failed: {}'.format(
+                    path, stderr.read().decode().strip()))
+
+    def removeFile(self, path):
+        '''Remove a remote file, if it exists'''
+        self.login()
+
+        if self.getTransferMethod() == 'sftp':
+            sftp = self.client.open_sftp()
+            try:
+                sftp.remove(path)
+            except IOError:
+                pass
+            finally:
+                sftp.close()
+            return
+
+        stdin, stdout, stderr = self.command('rm -f "{}"'.format(path))
+        if stdout.channel.recv_exit_status() != 0:
+            raise Exception(u'Removing {} failed: {}'.format(
+                path, stderr.read().decode().strip()))
+
+    def scpSend(self, path, data, mode=0o644):
+        '''Upload a file using SCP sink mode on the device (`scp -t`)'''
+        chan = self.client.get_transport().open_session(timeout=self.timeout)
+        chan.settimeout(self.command_timeout)
+        chan.exec_command('scp -t "{}"'.format(path))
+        stream = chan.makefile('rb')
+
+        def ack():
+            response = stream.read(1)
+            if response != b'\0':
+                raise Exception(u'SCP upload to {} failed: {}'.format(
+                    path, (response + stream.readline()).decode(errors='replace').strip()))
+
+        try:
+            ack()
+            chan.sendall('C{:04o} {} {}\n'.format(
+                mode, len(data), os.path.basename(path)).encode())
+            ack()
+            chan.sendall(data + b'\0')
+            ack()
+        finally:
+            chan.close()
+
+    def getChecksum(self, path):
+        '''MD5 of a remote file, or None if it does not exist
+
+        Downloads the file and hashes it locally. Devices with a checksum
+        tool should compute it on the device instead.
+        '''
+        data = self.getFiles([path]).get(path)
+        return hashlib.md5(data).hexdigest() if data is not None else None
+
     def login(self):
         '''Open SSH connection only if it is not already opened'''
         if self.client == False:
@@ -87,15 +393,29 @@ class SSHDevice:
             self.client = paramiko.SSHClient()
             self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
 
+            start = time.monotonic()
+
             # Try login with user/password
             try:
-                self.client.connect(self.ip, username=self.username, password=self.password,
-                                    timeout=5, allow_agent=False, look_for_keys=False)
+                sock = self.connect()
+                with profiler.phase('auth', self.ip):
+                    self.client.connect(self.ip, username=self.username, password=self.password,
+                                        timeout=self.timeout, allow_agent=False, look_for_keys=False,
+                                        sock=sock)
             except:
                 # Try login with RSA key
                 key = paramiko.RSAKey.from_private_key_file(self.rsa)
-                self.client.connect(
-                    self.ip, username=self.username, timeout=5, pkey=key)
+                sock = self.connect()
+                with profiler.phase('auth', self.ip):
+                    self.client.connect(
+                        self.ip, username=self.username, timeout=self.timeout, pkey=key, sock=sock)
+
+            self.latency = time.monotonic() - start
+
+    def connect(self, port=22):
+        '''Open the TCP connection for an SSH session'''
+        with profiler.phase('connect', self.ip):
+            return socket.create_connection((self.ip, port), timeout=self.timeout)
 
     def logout(self):
         '''Close SSH connection only if it is opened'''
@@ -109,7 +429,8 @@ class SSHDevice:
         '''Send command to device and return (stdin, stdout, stderr) streams tuple'''
         self.login()
 
-        return self.client.exec_command(command, timeout=5)
+        with profiler.phase('exec', self.ip):
+            return self.client.exec_command(command, timeout=self.command_timeout)
 
     def shell(self, *args, **kwargs):
         '''Opens a TTY shell'''
@@ -134,87 +455,354 @@ class SSHDevice:
             return u"{} : {}".format(self.name, self.ip)
 
 
-def backup_devices_list(devices, path):
-    '''Do backup on an ACDevice list'''
-    i = 1
-    failed = []
+def link_file(source, destination):
+    '''Hard link a file, or copy it if the filesystem does not allow it'''
+    if os.path.exists(destination):
+        os.unlink(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
 
+
+def print_jsonl(record):
+    '''Print a record as one compact JSON line and flush it, so it can be piped as soon as it is ready'''
+    sys.stdout.write(json.dumps(record, separators=(',', ':'), default=str) + "\n")
+    sys.stdout.flush()
+
+
+def prescan_devices(devices, port=22, timeout=1.0, rescans=1):
+    '''Sort devices into (reachable, unreachable) lists with a fast TCP scan
+
+    Devices not answering are scanned again `rescans` times, so a single
+    lost SYN does not skip a healthy device.
+    '''
+    hosts = [device.ip for device in devices]
+    answering = tcp_scan(hosts, port=port, timeout=timeout)
+    for i in range(rescans):
+        silent = [host for host in hosts if host not in answering]
+        if not silent:
+            break
+        answering |= tcp_scan(silent, port=port, timeout=timeout)
+
+    reachable = []
+    unreachable = []
     for device in devices:
+        if device.ip in answering:
+            reachable.append(device)
+        else:
+            device.unreachable = True
+            unreachable.append(device)
+
+    return reachable, unreachable
+
+
+def backup_warning(error):
+    '''Console warning for a backup error'''
+    if isinstance(error, paramiko.ssh_exception.AuthenticationException):
+        return u"[WARNING] Credencials incorrectes! (" + str(error) + ")"
+    if isinstance(error, paramiko.ssh_exception.NoValidConnectionsError):
+        return u"[WARNING] No es pot establir connexió al port 22! (" + str(error) + ")"
+    if isinstance(error, socket.timeout):
+        return u"[WARNING] Servidor no abastable! (" + str(error) + ")"
+    if isinstance(error, InvalidBackup):
+        return u"[WARNING] Backup invàlid! (" + str(error) + ")"
+    return u"[WARNING] Excepció no gestionada: " + str(error)
+
+
+def name_devices(devices, workers=8, output="text", scheduler=default_scheduler):
+    '''Resolve unknown devices names concurrently, as backup files are named after them
+
+    Returns (named, unnamed) devices lists. Unnamed devices get their `warning` set.
+    '''
+    errors = dict(resolve_names(devices, workers=workers, scheduler=scheduler))
+    for device, error in errors.items():
+        device.warning = backup_warning(error)
+        if output == "jsonl":
+            print_jsonl({'host': device.ip, 'status': 'failed', 'error': type(error).__name__,
+                         'message': u"Unknown name: " + str(error)})
+        else:
+            print(u"{} : {}".format(device.ip, colored(device.warning, 'red', attrs=['bold'])))
+
+    return [device for device in devices if device not in errors], list(errors)
+
+
+def name_backups(devices, workers=8, output="text", compress=False, scheduler=default_scheduler):
+    '''Name devices and their backup files. Returns (named, unnamed) devices lists
+
+    Backup files are named after devices: devices whose name can't be known
+    are not backed up. Compressed backup files get a `.gz` suffix.
+    '''
+    devices, unnamed = name_devices(devices, workers=workers, output=output, scheduler=scheduler)
+
+    if compress:
+        for device in devices:
+            if not device.backup_file.endswith(".gz"):
+                device.backup_file = device.backup_file + ".gz"
+
+    return devices, unnamed
+
+
+def backup_devices_list(devices, path, output="text", health=None, fingerprints=None, journal=None,
+                        workers=8, processes=None, compress=False, scheduler=default_scheduler):
+    '''Do backup on a devices list, as a staged pipeline
+
+    Network workers (threads, within `scheduler` limits) download backups
+    and hand them through a bounded queue to `processes` worker processes,
+    which validate, checksum, optionally gzip and write them. Devices are
+    reported as they finish. Returns the failed devices list.
+    '''
+    i = 1
+
+    devices, failed = name_backups(devices, workers=workers, output=output,
+                                   compress=compress, scheduler=scheduler)
+
+    def report(device, status, error=None, checksum=None, size=None):
+        nonlocal i
+
+        if output == "text":
+            print(u"{index}.- {device}".format(index=i, device=str(device)))
+        i += 1
 
-        # Debug:
-        # if i == 10:
-        #    break
+        if status == 'skipped':
+            if output == "text":
+                print(
+                    u"    " + colored("[WARNING] Backup ja realitzat. Saltem.", 'yellow', attrs=['bold']))
+            else:
+                print_jsonl({'host': device.ip, 'name': device.name,
+                             'file': device.backup_file, 'status': 'skipped'})
+            return
+
+        if output == "jsonl":
+            record = {'host': device.ip, 'name': device.name,
+                      'file': device.backup_file, 'status': status}
+            if error is not None:
+                record.update(error=type(error).__name__, message=str(error))
+            print_jsonl(record)
+
+        if journal is not None:
+            journal.record(device, status, error=error,
+                           checksum=checksum, size=size)
+
+        if error is not None:
+            device.warning = backup_warning(error)
+            if output == "text":
+                print(u"    " + colored(device.warning, 'red', attrs=['bold']))
+            failed.append(device)
+            return
+
+        if health is not None:
+            health.success(device.ip, device.latency)
 
-        print(u"{index}.- {device}".format(index=i, device=str(device)))
+        if status == 'unchanged' and output == "text":
+            print(u"    " + colored("[INFO] Configuració sense canvis. Reutilitzem el darrer backup.",
+                                    'green', attrs=['bold']))
+
+    pending = []
+    for device in devices:
+        file = os.path.join(path, device.backup_file)
 
-        # Debug:
-        # if i == 1:
-        #    pprint(device.data)
-        #    break
+        # Resumed runs only trust files verified by the journal
+        done = journal is not None and journal.is_done(device)
+        if not done and (journal is None or not journal.resumed):
+            done = os.path.exists(file) and os.stat(file).st_size > 0
+            if done and journal is not None:
+                journal.record(device, 'skipped')
 
-        warning = ""
-        file = path + "/" + device.backup_file
-        if os.path.exists(file) and os.stat(file).st_size > 0:
-            print(
-                u"    " + colored("[WARNING] Backup ja realitzat. Saltem.", 'yellow', attrs=['bold']))
+        if done:
+            report(device, 'skipped')
             continue
 
+        if health is not None:
+            device.timeout = health.timeout(device.ip)
+        pending.append(device)
+
+    if not pending:
+        return failed
+
+    # Fast-fail hosts known to be offline
+    if health is not None:
+        allowed = health.allowed(device.ip for device in pending)
+        for device in pending:
+            if device.ip not in allowed:
+                device.unreachable = True
+
+    # Network stage: downloads wait in a bounded queue for the CPU stage
+    processes = processes if processes is not None else os.cpu_count() or 1
+    downloads = queue.Queue(maxsize=2 * max(processes, 1))
+
+    def fetch(device):
+        data = fingerprint = error = None
         try:
-            device.backup(path)
-        except paramiko.ssh_exception.AuthenticationException as e:
-            warning = u"[WARNING] Credencials incorrectes! (" + str(e) + ")"
-        except paramiko.ssh_exception.NoValidConnectionsError as e:
-            warning = u"[WARNING] No es pot establir connexió al port 22! (" + str(
-                e) + ")"
-        except socket.timeout as e:
-            warning = u"[WARNING] Servidor no abastable! (" + str(e) + ")"
-        except KeyboardInterrupt as e:
-            raise e
+            if device.unreachable:
+                raise socket.timeout(
+                    "{} does not answer, skipped".format(device.ip))
+            data, fingerprint = device.fetchBackup(
+                path, fingerprints=fingerprints)
         except Exception as e:
-            warning = u"[WARNING] Excepció no gestionada: " + str(e)
+            error = e
         finally:
             device.logout()
-
-        if warning != "":
-            device.warning = warning
-            print(u"    " + colored(warning, 'red', attrs=['bold']))
-            failed.append(device)
-
-        # Higiene
-        else:
-            del device
-
-        i += 1
+        downloads.put((device, data, fingerprint, error))
+
+    network = threading.Thread(target=parallel_map, args=(fetch, pending),
+                               kwargs={'workers': workers, 'scheduler': scheduler},
+                               daemon=True)
+
+    # CPU stage: validate, checksum, compress and write, in other processes
+    if processes:
+        pool = ProcessPoolExecutor(max_workers=processes,
+                                   mp_context=multiprocessing.get_context('spawn'))
+    else:
+        pool = ThreadPoolExecutor(max_workers=1)
+
+    processing = {}
+    received = 0
+    try:
+        network.start()
+        while received < len(pending) or processing:
+
+            # Take downloads while there is room in the processes pool
+            while received < len(pending) and len(processing) < 2 * max(processes, 1):
+                try:
+                    device, data, fingerprint, error = downloads.get(
+                        timeout=0.1 if processing else None)
+                except queue.Empty:
+                    break
+                received += 1
+
+                if error is not None:
+                    report(device, 'failed', error=error)
+                elif data is None:
+                    report(device, 'unchanged')
+                else:
+                    future = pool.submit(process_backup, data,
+                                         os.path.join(path, device.backup_file),
+                                         format=device.backup_format, compress=compress)
+                    processing[future] = (device, fingerprint)
+
+            if not processing:
+                continue
+
+            finished, running = wait(
+                processing, timeout=0.1, return_when=FIRST_COMPLETED)
+            for future in finished:
+                device, fingerprint = processing.pop(future)
+                try:
+                    checksum, size = future.result()
+                except Exception as e:
+                    report(device, 'failed', error=e)
+                    continue
+                device.saveFingerprint(fingerprint, fingerprints)
+                report(device, 'ok', checksum=checksum, size=size)
+
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
 
     return failed
 
 
-def backup_devices(devices, path, retries=3):
+def backup_devices(devices, path, retries=3, output="text", health=None, prescan=False, incremental=False,
+                   journal=False, resume=False, workers=8, processes=None, compress=False,
+                   prescan_timeout=1.0, scheduler=default_scheduler):
     # Ensure backup dir exists
-    print(u"Make dir: " + path)
+    if output == "text":
+        print(u"Make dir: " + path)
     os.makedirs(path, exist_ok=True)
 
-    failed = devices
-    ok = 0
-    while retries > 0:
-
-        total = len(failed)
+    # Last config fingerprint of every device
+    fingerprints = None
+    if incremental:
+        fingerprints = JSONStore(os.path.join(path, ".fingerprints.json"))
 
-        # Do backup and get failed list
-        failed = backup_devices_list(failed, path)
+    # Run journal, continuing last run if resuming
+    if journal or resume:
+        journal = BackupJournal(path, resume=resume)
+    else:
+        journal = None
 
-        # Sum non-failed to 'ok' counter
-        ok += total - len(failed)
-
-        # If list is empty, break while
-        if len(failed) == 0:
-            break
+    devices, unnamed = name_backups(devices, workers=workers, output=output,
+                                    compress=compress, scheduler=scheduler)
 
-        # Decrease counter
-        retries -= 1
-        if retries > 0:
-            print(colored(u"\nTornem a intentar amb les antenes que hagin fallat (queden {} intents, {} fallats)\n".format(
-                retries-1, len(failed)), 'white', attrs=['bold']))
+    failed = devices
+    unreachable = []
+    exhausted = []
+    attempts = retries
+    ok = 0
+    try:
+        # Don't repeat finished work of a resumed run
+        if journal is not None and journal.resumed:
+            failed = [f for f in devices if not journal.is_done(f)]
+            ok += len(devices) - len(failed)
+
+        # Spend SSH effort only on devices answering on port 22
+        if prescan:
+            failed, unreachable = prescan_devices(failed, timeout=prescan_timeout)
+            if output == "text":
+                print(colored(u"Pre-scan: {} abastables, {} no abastables".format(
+                    len(failed), len(unreachable)), 'white', attrs=['bold']))
+            for device in unreachable:
+                device.warning = u"[WARNING] Servidor no abastable! (no respon al port 22)"
+                if journal is not None:
+                    journal.record(device, 'failed', error=socket.timeout(
+                        "No answer on port 22"))
+                if output == "jsonl":
+                    print_jsonl({'host': device.ip, 'status': 'failed',
+                                 'error': 'unreachable', 'message': 'No answer on port 22'})
+
+        while retries > 0:
+
+            # Devices which already used all their attempts (in a resumed run)
+            if journal is not None:
+                for f in failed:
+                    if journal.attempts(f.ip) >= attempts:
+                        f.warning = journal.last_error(f.ip)
+                        exhausted.append(f)
+                failed = [f for f in failed if f not in exhausted]
+
+            total = len(failed)
+
+            # Do backup and get failed list
+            failed = backup_devices_list(
+                failed, path, output=output, health=health, fingerprints=fingerprints, journal=journal,
+                workers=workers, processes=processes, compress=compress, scheduler=scheduler)
+
+            # Sum non-failed to 'ok' counter
+            ok += total - len(failed)
+
+            # Don't retry devices known to be unreachable
+            unreachable += [f for f in failed if f.unreachable]
+            failed = [f for f in failed if not f.unreachable]
+
+            # If list is empty, break while
+            if len(failed) == 0:
+                break
+
+            # Decrease counter
+            retries -= 1
+            if retries > 0 and output == "text":
+                print(colored(u"\nTornem a intentar amb les antenes que hagin fallat (queden {} intents, {} fallats)\n".format(
+                    retries-1, len(failed)), 'white', attrs=['bold']))
+
+        failed += unreachable + exhausted + unnamed
+
+        # Count a failed run for every device still failing
+        if health is not None:
+            for f in failed:
+                health.failure(f.ip)
+
+    finally:
+        # Persist health records and fingerprints, even on interruption
+        if health is not None:
+            health.save()
+        if fingerprints is not None:
+            fingerprints.save()
+        if journal is not None:
+            journal.close()
+
+    if output == "jsonl":
+        print_jsonl({'summary': {'ok': ok, 'failed': len(failed)}})
+        return
 
     # Print totals
     print(u"\n")
@@ -228,7 +816,91 @@ def backup_devices(devices, path, retries=3):
     if len(failed) > 0:
         print(u"Failed %d devices:" % (len(failed)))
         for f in failed:
-            print(u" - {device}: {warning}".format(device=str(f),
+            print(u" - {device}: {warning}".format(device=str(f) if f.has_name() else f.ip,
                   warning=colored(f.warning, 'red', attrs=['bold'])))
 
         print(u"\n")
+
+
+def restore_previous(device, path, previous, error):
+    '''Default push rollback: restore the previous remote file contents, or remove the file if there was none'''
+    if previous is not None:
+        device.putFile(path, previous)
+    else:
+        device.removeFile(path)
+
+
+def push_device(device, path=None, data=None, mode=0o644, script=None, rollback=restore_previous):
+    '''Upload a file and/or run a script on a device
+
+    The uploaded file is verified by checksum. If upload, verification or
+    script fail, `rollback(device, path, previous, error)` is called with the
+    previous file contents (None if it did not exist) and the error is raised.
+    The default rollback restores the previous file, or removes the new one.
+    If the previous file can't be read, nothing is changed on the device.
+    '''
+    try:
+        previous = device.getFiles([path]).get(path) if path is not None else None
+
+        try:
+            if path is not None:
+                device.putFile(path, data, mode)
+
+                checksum = device.getChecksum(path)
+                if checksum != hashlib.md5(data).hexdigest():
+                    raise Exception(u'Checksum mismatch on {}: {}'.format(
+                        path, checksum))
+
+            if script is not None:
+                stdin, stdout, stderr = device.command(script)
+                if stdout.channel.recv_exit_status() != 0:
+                    raise Exception(u'Script failed: {}'.format(
+                        stderr.read().decode().strip()))
+
+        except Exception as e:
+            if rollback is not None and path is not None:
+                rollback(device, path, previous, e)
+            raise
+
+    finally:
+        device.logout()
+
+
+def push_devices(devices, path=None, data=None, mode=0o644, script=None,
+                 rollback=restore_previous, workers=8, rate=None, output="text",
+                 scheduler=default_scheduler):
+    '''Push a file and/or a script to many devices concurrently
+
+    At most `workers` devices are pushed at once, within the `scheduler`
+    limits, and if `rate` is given, no more than `rate` devices are started
+    per second. Returns the failed
+    devices list, with their `warning` set.
+    '''
+    bucket = TokenBucket(rate) if rate else None
+
+    def push(device):
+        if bucket is not None:
+            bucket.acquire()
+        push_device(device, path=path, data=data, mode=mode,
+                    script=script, rollback=rollback)
+
+    failed = []
+    for device, result, error in parallel_map(push, devices, workers=workers, scheduler=scheduler):
+        if error is not None:
+            device.warning = u"[WARNING] " + str(error)
+            failed.append(device)
+
+        if output == "jsonl":
+            record = {'host': device.ip, 'status': 'ok'}
+            if error is not None:
+                record.update(status='failed', error=type(error).__name__,
+                              message=str(error))
+            print_jsonl(record)
+        elif error is not None:
+            print(u"{device}: {warning}".format(device=str(device),
+                  warning=colored(device.warning, 'red', attrs=['bold'])))
+        else:
+            print(u"{device}: {ok}".format(device=str(device),
+                  ok=colored("OK", 'green', attrs=['bold'])))
+
+    return failed
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import tempfile
+import threading
+
+
+class JSONStore():
+    '''Dict-like storage persisted as a JSON file'''
+
+    path = None
+    data = None
+
+    def __init__(self, path=None):
+        '''Load data from `path`, if any. Without path, data only lives in memory'''
+        self.path = path
+        self.data = {}
+        self.lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        '''Load data from file, ignoring missing or corrupted files'''
+        if not self.path or not os.path.isfile(self.path):
+            return
+
+        try:
+            with open(self.path, "r") as f:
+                self.data = json.load(f)
+        except ValueError:
+            self.data = {}
+
+    def save(self):
+        '''Atomically write data to file'''
+        if not self.path:
+            return
+
+        with self.lock:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(self.data, f, separators=(',', ':'))
+                os.replace(tmp, self.path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def items(self):
+        return self.data.items()
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.data[key] = value
+
+    def __delitem__(self, key):
+        with self.lock:
+            del self.data[key]
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
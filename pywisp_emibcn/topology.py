@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+class Topology():
+    '''Network tree built once from AirControl devices `parentId`
+
+    Devices are laid out in depth-first order, so every subtree is a
+    contiguous range of that order: subtrees are answered in O(k), client
+    counts and ancestry checks in O(1), and uplink paths in O(depth).
+    Devices whose parent is unknown are roots. Devices are identified by
+    `key(dev)` (their deviceId by default) and their parent by `parent(dev)`.
+    '''
+
+    def __init__(self, devices, key=None, parent=None):
+        key = key or (lambda dev: dev['deviceId'])
+        parent_key = parent or (lambda dev: dev.get('parentId'))
+
+        self.devices = {key(dev): dev for dev in devices}
+        self.parents = {}
+        self.children = {id: [] for id in self.devices}
+
+        for id, dev in self.devices.items():
+            parent = parent_key(dev)
+            if parent in self.devices and parent != id:
+                self.parents[id] = parent
+                self.children[parent].append(id)
+
+        # Depth-first layout: order[first[id]:last[id]] is id's subtree
+        self.order = []
+        self.first = {}
+        self.last = {}
+        self.depths = {}
+
+        roots = [id for id in self.devices if id not in self.parents]
+        # Devices in parentId loops have no root: break the loop anywhere
+        pending = roots + [id for id in self.devices if id in self.parents]
+        for root in pending:
+            if root in self.first:
+                continue
+            self.layout(root)
+
+    def layout(self, root):
+        '''Iterative depth-first walk from `root`'''
+        self.depths[root] = 0
+        stack = [(root, False)]
+        while stack:
+            id, done = stack.pop()
+            if done:
+                self.last[id] = len(self.order)
+                continue
+
+            self.first[id] = len(self.order)
+            self.order.append(id)
+            stack.append((id, True))
+            for child in reversed(self.children[id]):
+                if child not in self.first:
+                    self.depths[child] = self.depths[id] + 1
+                    stack.append((child, False))
+
+    def subtree(self, id, include_self=False):
+        '''Devices hanging (directly or not) from `id`, in depth-first order'''
+        start = self.first[id] + (0 if include_self else 1)
+        return [self.devices[i] for i in self.order[start:self.last[id]]]
+
+    def client_count(self, id):
+        '''Number of devices hanging (directly or not) from `id`'''
+        return self.last[id] - self.first[id] - 1
+
+    def ancestors(self, id):
+        '''Uplink path of `id`: its parent, its parent's parent, ... up to its root'''
+        path = []
+        seen = {id}
+        while id in self.parents and self.parents[id] not in seen:
+            id = self.parents[id]
+            seen.add(id)
+            path.append(self.devices[id])
+        return path
+
+    def is_ancestor(self, ancestor, id):
+        '''Does `id` hang (directly or not) from `ancestor`?'''
+        return ancestor != id and \
+            self.first[ancestor] <= self.first[id] < self.last[ancestor]
+
+    def depth(self, id):
+        return self.depths[id]
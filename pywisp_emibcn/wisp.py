@@ -1,7 +1,10 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from pywisp_emibcn.aircontrol import ACSession
+from pywisp_emibcn.aircontrol import ACDevice, ACSession, ACFederation, get_client_from_wifi_station
+from pywisp_emibcn.match import HostMatcherSet
+from pywisp_emibcn.mikrotik import LeaseIndex
+from pywisp_emibcn.parallel import parallel_map, default_scheduler
 from pprint import pprint
 
 
@@ -17,11 +20,20 @@ class Wisp():
     __log = None
     __getlogger = None
 
-    def __init__(self, ac_conf=None, getlog=None):
+    # Limits for concurrent operations against the infrastructure
+    scheduler = default_scheduler
+
+    # Deep lookups ask first the BRs where clients were seen last
+    use_location_index = True
+
+    def __init__(self, ac_conf=None, getlog=None, scheduler=None):
 
         if getlog:
             self.getlogger = getlog
 
+        if scheduler:
+            self.scheduler = scheduler
+
         if ac_conf:
             self.ac_conf = ac_conf
             self.log.debug("__init__: Loaded AC configuration: %s" %
@@ -53,23 +65,44 @@ class Wisp():
 
     @property
     def ac(self):
+        '''AirControl session. If `ac_conf` maps names to several servers
+        configurations, a federation of all of them'''
 
         if not self.__ac:
-            self.__ac = ACSession(
-                self.ac_conf['url'], self.ac_conf['user'], self.ac_conf['password'])
+            if 'url' in self.ac_conf:
+                self.__ac = self.ac_session(self.ac_conf)
+            else:
+                self.__ac = ACFederation({
+                    name: self.ac_session(conf)
+                    for name, conf in self.ac_conf.items()
+                })
+                for session in self.__ac.sessions.values():
+                    session.scheduler = self.scheduler
+            self.__ac.scheduler = self.scheduler
             self.__ac.login()
 
+            for name, error in getattr(self.__ac, 'errors', {}).items():
+                self.log.warning(
+                    "Could not login to AirControl server %s: %s" % (name, str(error)))
+
         return self.__ac
 
     @ac.setter
     def ac(self, ac):
         self.__ac = ac
 
+    @staticmethod
+    def ac_session(conf):
+        '''AirControl session from its configuration'''
+        session = ACSession(conf['url'], conf['user'], conf['password'])
+        session.stream = str(conf.get('stream', "")).lower() in ('1', 'yes', 'true', 'on')
+        return session
+
     def get_host(self, name, deep=False, from_br=None):
         raise NotImplementedError("Should have implemented `get_host` method")
 
-    def get_ac_devices(self):
-        '''Generate antennas list (with credentials)'''
+    def get_ac_devices(self, devices=None):
+        '''Generate antennas list (with credentials), from all AirControl devices or from a list of them'''
         raise NotImplementedError(
             "Should have implemented `get_ac_devices` method")
 
@@ -83,42 +116,124 @@ class Wisp():
         raise NotImplementedError(
             "Should have implemented `get_mt_devices` method")
 
-    def get_aircontrol_deep(self, name, from_br=None):
+    def harvest_dhcp_leases(self, routers, name="", bound=None, workers=8):
+        '''Get DHCP leases from many Mikrotik routers concurrently
+
+        Returns a `LeaseIndex` merging all leases by MAC and hostname. A
+        failing router is logged and saved in its `errors`, without stopping
+        the others.
+        '''
+        def harvest(router):
+            try:
+                return router.getDHCPLeases(name=name, bound=bound)
+            finally:
+                router.logout()
+
+        index = LeaseIndex()
+        for router, leases, error in parallel_map(harvest, routers, workers=workers,
+                                                  scheduler=self.scheduler,
+                                                  targets=lambda router: ["ccr:{}".format(router.ip)]):
+            if error is not None:
+                self.log.warning(
+                    "There was a problem getting DHCP leases from %s: %s" % (router.ip, str(error)))
+                index.errors[router.ip] = error
+            else:
+                index.add(router, leases)
+
+        return index
+
+    def get_subtree(self, devices):
+        '''Devices (with credentials) hanging from any of the given AirControl devices'''
+        topology = self.ac.getTopology()
+
+        subtree = []
+        seen = set()
+        for device in devices:
+            if device.key not in topology.devices:
+                self.log.warning(
+                    "%s is not in AirControl topology" % (device.name))
+                continue
+            for dev in topology.subtree(device.key):
+                key = self.ac.deviceKey(dev)
+                if key not in seen:
+                    seen.add(key)
+                    subtree.append(dev)
+
+        return self.get_ac_devices(subtree)
+
+    def get_aircontrol_deep(self, name, from_br=None, use_index=None):
+        '''Find hosts using all BRs station list as haystack
+
+        `name` can be a query or a list of queries (see `HostMatcher`), all of
+        them matched in one pass against every station table.
+
+        With a clients location index (`ACDevice.location_index`) knowing
+        where every query was seen last, only those BRs are asked. This is
+        done only for exact MAC and IP queries, as other queries may match
+        new clients anywhere, and all BRs are asked unless every query is
+        found again there.
+        '''
         self.log.info("Download BRs...")
 
-        repetidors = self.get_ac_brs(from_br=None)
+        repetidors = self.get_ac_brs(from_br=from_br)
 
         self.log.info("BRs found: %s" % (len(repetidors)))
 
-        clients_total = []
-        clients_wifi = []
-        for repetidor in repetidors:
+        matchers = HostMatcherSet(name) if name else None
+
+        if use_index is None:
+            use_index = self.use_location_index
+
+        index = ACDevice.location_index
+        if use_index and matchers and index is not None and \
+                all(matcher.exact for matcher in matchers.matchers):
+            brs, found = index.locate(matchers)
+            if brs and len(found) == len(matchers.matchers):
+                located = [br for br in repetidors
+                           if (br.controller, br.id) in brs]
+                self.log.info("Located in BRs: %s" % (
+                    ", ".join(br.name for br in located)))
+                found = set()
+                clients = self.get_aircontrol_deep_brs(located, matchers, found=found)
+                if len(found) == len(matchers.matchers):
+                    return clients
+                self.log.info("Not all found where located, asking all BRs")
+
+        return self.get_aircontrol_deep_brs(repetidors, matchers)
+
+    def get_aircontrol_deep_brs(self, repetidors, matchers=None, found=None):
+        '''Find hosts matching a `HostMatcherSet` in these BRs station lists
+
+        Matchers which matched any station are added to the `found` set, if given.
+        '''
+
+        def download(repetidor):
+            self.log.info("Download wifi stations from %s" %
+                          (repetidor.name))
             try:
-                self.log.info("Download wifi stations from %s" % (repe.name))
-                clients_wifi = repetidor.getWifiStations()
-            except Exception as e:
+                return repetidor.getWifiStations()
+            finally:
+                repetidor.logout()
+
+        # Download BRs station lists concurrently, within scheduler limits
+        clients_total = []
+        for repetidor, clients_wifi, error in parallel_map(
+                download, repetidors, workers=self.scheduler.workers, scheduler=self.scheduler,
+                targets=lambda br: br.getTargets() + ["br:{}".format(br.id)]):
+            if error is not None:
                 self.log.warning(
-                    "There was a problem connecting to %s: %s" % (repe.name, str(e)))
+                    "There was a problem connecting to %s: %s" % (repetidor.name, str(error)))
                 continue
 
-            clients = [
-                {
-                    'deviceId': -1,
-                    'properties': {
-                        'hostname': cw['remote']['hostname'],
-                        'ip': cw['lastip'],
-                        'mac': cw['mac'],
-                    }
-                }
-                for cw in clients_wifi
-                if not name or
-                (
-                    name in cw['mac'].lower() or
-                    name in cw['lastip'] or
-                    ('remote' in cw and name in cw['remote']
-                        ['hostname'].lower())
-                )
-            ]
+            if matchers:
+                stations = matchers.match_stations(clients_wifi)
+                clients_wifi = [station for station, matched in stations]
+                if found is not None:
+                    for station, matched in stations:
+                        found.update(matched)
+
+            clients = [get_client_from_wifi_station(
+                cw) for cw in clients_wifi]
 
             for client in clients:
                 self.log.info("%s - %s - %s" % (client['properties']['hostname'],
@@ -128,15 +243,22 @@ class Wisp():
 
         return clients_total
 
+    def sweep_locations(self, from_br=None):
+        '''Update clients location index with every BR station list'''
+        clients = self.get_aircontrol_deep_brs(self.get_ac_brs(from_br=from_br))
+        if ACDevice.location_index is not None:
+            ACDevice.location_index.save()
+        return clients
+
     def ac_reorder_branches(self):
-        # Get devices list
-        devices = self.get_ac_devices(self.ac.getDevices())
+        # Get devices list as compact records: no SSH nor full JSON needed
+        devices = self.ac.getDeviceRecords()
 
         # Separate BRs and the rest of clients
         brs = []
         clients = []
-        for antena in antenas:
-            if antena.data['properties']['wlanOpModeString'] != 'sta':
+        for antena in devices:
+            if antena.mode != 'sta':
                 brs.append(antena)
             else:
                 clients.append(antena)
@@ -146,10 +268,11 @@ class Wisp():
         patchList = []
         for br in brs:
             self.log.info("- %s (%s)" % (br.name, br.id))
-            # For each client connectetd to it's SSID
+            # For each client connectetd to it's SSID (parents are only
+            # possible within the same AirControl server)
             for client in clients:
-                if client.ssid == br.ssid:
-                    if client.branch == br.id:
+                if client.ssid == br.ssid and client.controller == br.controller:
+                    if client.parent_key == br.key:
                         self.log.info("   - %s (%s)" %
                                       (client.name, client.ssid))
                     else:
@@ -158,13 +281,13 @@ class Wisp():
                             client=client.name,
                             clid=client.id,
                             clessid=client.ssid,
-                            branch=client.branch,
+                            branch=client.parent,
                             brname=br.name,
                             brid=br.id))
 
                         patchList.append(
                             self.ac.patchDeviceCreate(
-                                client.id, {"parentId": br.id})
+                                client.key, {"parentId": br.id})
                         )
 
         # Send patches
@@ -0,0 +1,66 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import gzip
+import os
+import tempfile
+
+from pywisp_emibcn.aircontrol import ACDevice
+from pywisp_emibcn.archive import ArchiveIndex, parse_backup_name
+
+
+def test_archive_index():
+    path = tempfile.mkdtemp()
+    with open(os.path.join(path, "cpe1.2021-01-01.bkp.tar"), "wb") as f:
+        f.write(ACDevice.tarFiles({
+            '/tmp/system.cfg': b"wireless.1.ssid=MyWISP-North\nnetmode=bridge\n",
+            '/tmp/other': b"ssid=Ignored\n",
+        }))
+    with gzip.open(os.path.join(path, "ccr1.2021-01-02.bkp.gz"), "wb") as f:
+        f.write(b"# by RouterOS\n/interface vlan\nadd name=vlan42 vlan-id=42\n")
+    with open(os.path.join(path, ".health.json"), "w") as f:
+        f.write("{}")
+
+    assert parse_backup_name("cpe1.2021-01-01.bkp.tar.gz") == ("cpe1", "2021-01-01", True)
+    assert parse_backup_name(".health.json") is None
+
+    index = ArchiveIndex(path)
+    assert index.update() == 2
+    assert index.update() == 0
+
+    [result] = index.search("mywisp-north")
+    assert (result['device'], result['date'], result['member']) == (
+        "cpe1", "2021-01-01", "tmp/system.cfg")
+    assert result['lines'] == ["wireless.1.ssid=MyWISP-North"]
+
+    assert [r['device'] for r in index.search("vlan-id=42")] == ["ccr1"]
+    assert index.search("Ignored") == []
+
+    # Newer backups are indexed, removed ones forgotten
+    os.unlink(os.path.join(path, "ccr1.2021-01-02.bkp.gz"))
+    with open(os.path.join(path, "ccr1.2021-01-03.bkp"), "w") as f:
+        f.write("# by RouterOS\n/interface vlan\nadd name=vlan43 vlan-id=43\n")
+    assert index.update() == 1
+    assert [r['date'] for r in index.search("vlan", latest=True)] == ["2021-01-03"]
+
+
+class LikeIndex(ArchiveIndex):
+    '''Index without FTS5, as on SQLite builds lacking it'''
+    fts = False
+
+
+def test_archive_index_like():
+    path = tempfile.mkdtemp()
+    with open(os.path.join(path, "ccr1.2021-01-01.bkp"), "w") as f:
+        f.write("# by RouterOS\nset rate=100%\nadd name=vlan_42\n")
+    with open(os.path.join(path, "ccr2.2021-01-01.bkp"), "w") as f:
+        f.write("# by RouterOS\nset rate=1000\nadd name=vlanX42\n")
+
+    index = LikeIndex(path)
+    index.update()
+
+    # LIKE wildcards in the term match only themselves
+    assert [r['device'] for r in index.search("vlan_42")] == ["ccr1"]
+    assert [r['device'] for r in index.search("100%")] == ["ccr1"]
+    assert index.search("%X") == []
+    index.close()
@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+
+from pywisp_emibcn import audit as audit_module
+from pywisp_emibcn.aircontrol import ACDevice
+from pywisp_emibcn.audit import Audit, parse_export, parse_system_cfg
+
+EXPORT = '''# jan/02/1970 00:00:00 by RouterOS 6.48.6
+# software id = ABCD-1234
+#
+# model = CCR1036-8G-2S+
+/interface ethernet
+set [ find default-name=ether1 ] comment="Uplink \\"main\\"" name=wan
+/ip address
+add address=10.0.0.1/24 interface=wan
+add address=10.0.1.1/24 \\
+    interface=lan
+/ip service
+set telnet disabled=yes
+set www address=10.0.0.0/8
+/system identity
+set name=ccr1
+'''
+
+RULES = [
+    {'id': 'chanbw', 'format': 'airos', 'key': 'radio.1.chanbw', 'in': [20, 40]},
+    {'id': 'no-telnet', 'format': 'routeros', 'key': '/ip service telnet.disabled',
+     'equals': 'yes', 'default': 'no'},
+    {'id': 'no-ftp', 'format': 'routeros', 'key': '/ip service ftp.disabled',
+     'equals': 'yes', 'default': 'no'},
+    {'id': 'lan-only', 'format': 'routeros', 'keys': r'/ip address\[\d+\]\.address',
+     'regex': r'^10\.0\.0\.'},
+    {'id': 'v6', 'when': {'version': r'^7\.'}, 'key': 'name', 'present': True},
+]
+
+
+def test_parse():
+    assert parse_system_cfg("radio.1.chanbw=20\n# comment\nnetmode=bridge\n") == {
+        'radio.1.chanbw': '20', 'netmode': 'bridge'}
+
+    config = parse_export(EXPORT)
+    assert config['version'] == "6.48.6"
+    assert config['model'] == "CCR1036-8G-2S+"
+    assert config['/interface ethernet default-name=ether1.name'] == "wan"
+    assert config['/interface ethernet default-name=ether1.comment'] == 'Uplink "main"'
+    assert config['/ip address[1].interface'] == "lan"
+    assert config['/ip service telnet.disabled'] == "yes"
+    assert config['/system identity.name'] == "ccr1"
+
+
+def test_audit(monkeypatch):
+    path = tempfile.mkdtemp()
+    with open(os.path.join(path, "ccr1.2021-01-01.bkp"), "w") as f:
+        f.write(EXPORT)
+    with open(os.path.join(path, "cpe1.2021-01-01.bkp.tar"), "wb") as f:
+        f.write(ACDevice.tarFiles({'/tmp/system.cfg': b"radio.1.chanbw=80\n"}))
+    with open(os.path.join(path, "cpe1.2020-12-01.bkp.tar"), "wb") as f:
+        f.write(b"broken")
+
+    # Count backups parsed (in-process, with processes=0)
+    parsed = []
+    original = audit_module.parse_backup
+
+    def parse_backup(file):
+        parsed.append(os.path.basename(file))
+        return original(file)
+    monkeypatch.setattr(audit_module, 'parse_backup', parse_backup)
+
+    audit = Audit(path, processes=0)
+    results = {r['device']: [v['rule'] for v in r['violations']]
+               for r in audit.run(RULES)}
+    assert results == {'ccr1': ['no-ftp', 'lan-only'], 'cpe1': ['chanbw']}
+
+    assert sorted(parsed) == ["ccr1.2021-01-01.bkp", "cpe1.2021-01-01.bkp.tar"]
+
+    # Unchanged backups are not parsed again
+    assert [r['violations'] for r in audit.run(RULES)] == [
+        r['violations'] for r in audit.run(RULES[:4])] != []
+    assert len(parsed) == 2
+
+    all_results = audit.run(RULES, latest=False)
+    assert [v['rule'] for v in all_results[1]['violations']] == ['unreadable']
+
+    # Unreadable backups are reported with any rules set
+    all_results = audit.run(RULES[:2], latest=False)
+    assert [v['rule'] for v in all_results[1]['violations']] == ['unreadable']
+    audit.close()
+
+    audit = Audit(path, processes=0)
+    all_results = audit.run(RULES[1:], latest=False)
+    assert [v['rule'] for v in all_results[1]['violations']] == ['unreadable']
+    audit.close()
@@ -0,0 +1,199 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+
+from pywisp_emibcn.journal import BackupJournal
+from pywisp_emibcn.parallel import Scheduler
+from pywisp_emibcn.sshdevice import SSHDevice, backup_devices
+from pywisp_emibcn.store import JSONStore
+
+
+class FakeDevice(SSHDevice):
+    '''Device answering backups without any SSH connection'''
+
+    config = b"config"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.downloads = 0
+
+    def login(self):
+        pass
+
+    def getFingerprint(self):
+        return "fingerprint-" + self.config.decode()
+
+    def getBackup(self):
+        self.downloads += 1
+        return self.config
+
+
+def test_incremental_backup():
+    path = tempfile.mkdtemp()
+    fingerprints = JSONStore(os.path.join(path, ".fingerprints.json"))
+
+    device = FakeDevice(ip="10.1.1.1", name="dev", backup_file="dev.1.bkp")
+    assert device.backup(path, fingerprints=fingerprints)
+    assert device.downloads == 1
+    assert fingerprints["10.1.1.1"] == {
+        'fingerprint': "fingerprint-config", 'file': "dev.1.bkp"}
+
+    # Same fingerprint: the previous backup is linked, not downloaded
+    device.backup_file = "dev.2.bkp"
+    assert not device.backup(path, fingerprints=fingerprints)
+    assert device.downloads == 1
+    with open(os.path.join(path, "dev.2.bkp"), "rb") as f:
+        assert f.read() == b"config"
+    assert fingerprints["10.1.1.1"]['file'] == "dev.2.bkp"
+
+    # Changed fingerprint: downloaded again
+    device.config = b"changed"
+    device.backup_file = "dev.3.bkp"
+    assert device.backup(path, fingerprints=fingerprints)
+    assert device.downloads == 2
+    with open(os.path.join(path, "dev.3.bkp"), "rb") as f:
+        assert f.read() == b"changed"
+
+
+class FailingDevice(FakeDevice):
+
+    def getBackup(self):
+        self.downloads += 1
+        raise Exception("Broken device")
+
+
+def test_journal_resume():
+    path = tempfile.mkdtemp()
+    journal = BackupJournal(path)
+    ok = FakeDevice(ip="10.1.1.1", name="ok", backup_file="ok.bkp")
+    ok.storeBackup(path, b"config")
+    journal.record(ok, 'ok')
+    journal.record(FailingDevice(ip="10.1.1.2", name="ko"), 'failed',
+                   error=Exception("Broken device"))
+    journal.close()
+
+    journal = BackupJournal(path, resume=True)
+    assert journal.resumed
+    assert journal.is_done(ok)
+    assert journal.attempts("10.1.1.1") == 1
+    assert journal.attempts("10.1.1.2") == 1
+    assert journal.last_error("10.1.1.2") == "Broken device"
+    assert not journal.is_done(FakeDevice(ip="10.1.1.2", name="ko"))
+
+    # Resumed on another day: that day's backup is not done yet
+    assert not journal.is_done(
+        FakeDevice(ip="10.1.1.1", name="ok", backup_file="ok.next.bkp"))
+
+    # Files not matching their journaled checksum are not trusted
+    with open(os.path.join(path, "ok.bkp"), "wb") as f:
+        f.write(b"CONFIG")
+    assert not journal.is_done(ok)
+    journal.close()
+
+    # A new run (not resumed) starts from scratch
+    journal = BackupJournal(path)
+    assert not journal.resumed
+    assert journal.attempts("10.1.1.2") == 0
+    journal.close()
+
+
+def test_journal_compaction():
+    path = tempfile.mkdtemp()
+    file = os.path.join(path, BackupJournal.file_name)
+    device = FailingDevice(ip="10.1.1.2", name="ko")
+
+    for run in range(3):
+        journal = BackupJournal(path, resume=True)
+        journal.record(device, 'failed', error=Exception("Broken device"))
+        journal.close()
+
+    # Resumed runs keep only the latest record of every device
+    journal = BackupJournal(path, resume=True)
+    assert journal.attempts("10.1.1.2") == 3
+    with open(file) as f:
+        assert len(f.readlines()) == 2
+    journal.close()
+
+    # New runs start an empty journal
+    BackupJournal(path).close()
+    with open(file) as f:
+        assert len(f.readlines()) == 1
+
+
+def test_backup_devices_resume(capsys):
+    path = tempfile.mkdtemp()
+
+    def devices():
+        return [FakeDevice(ip="10.1.1.1", name="ok", backup_file="ok.bkp"),
+                FailingDevice(ip="10.1.1.2", name="ko", backup_file="ko.bkp")]
+
+    first = devices()
+    backup_devices(first, path, retries=1, journal=True, processes=0)
+    assert [device.downloads for device in first] == [1, 1]
+
+    # Finished devices are not backed up again, failed ones keep their attempts
+    second = devices()
+    backup_devices(second, path, retries=3, resume=True, processes=0)
+    assert [device.downloads for device in second] == [0, 2]
+
+    journal = BackupJournal(path, resume=True)
+    assert journal.attempts("10.1.1.2") == 3
+    journal.close()
+
+    # Every attempt used: not tried again
+    third = devices()
+    backup_devices(third, path, retries=3, resume=True, processes=0)
+    assert [device.downloads for device in third] == [0, 0]
+    assert "Broken device" in capsys.readouterr().out
+
+
+class UnnamedDevice(FakeDevice):
+    '''Device given only by IP, asked for its name'''
+
+    def getName(self):
+        if self.ip == "10.1.1.9":
+            raise OSError("No route to host")
+        self.name = "ccr-" + self.ip.split('.')[-1]
+
+
+def test_backup_unnamed_devices(capsys):
+    path = tempfile.mkdtemp()
+    devices = [UnnamedDevice(ip="10.1.1.1"), UnnamedDevice(ip="10.1.1.9")]
+
+    backup_devices(devices, path, retries=1, output="jsonl", journal=True,
+                   processes=0, compress=True)
+
+    assert devices[0].downloads == 1
+    assert devices[0].backup_file.startswith("ccr-1.") and devices[0].backup_file.endswith(".bkp.gz")
+    assert os.path.isfile(os.path.join(path, devices[0].backup_file))
+
+    # Devices whose name can't be known fail alone
+    assert devices[1].downloads == 0
+    assert capsys.readouterr().out.splitlines()[-1] == '{"summary":{"ok":1,"failed":1}}'
+
+
+class RecordingScheduler(Scheduler):
+    '''Scheduler remembering the targets it gave slots for'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.targets = []
+
+    def slot(self, *targets, globally=True):
+        self.targets += targets
+        return super().slot(*targets, globally=globally)
+
+
+def test_backup_scheduler():
+    path = tempfile.mkdtemp()
+    scheduler = RecordingScheduler()
+    devices = [UnnamedDevice(ip="10.1.1.1"), FakeDevice(ip="10.1.1.2", name="dev")]
+
+    backup_devices(devices, path, retries=1, output="jsonl", processes=0,
+                   scheduler=scheduler)
+
+    # Both naming and downloads run within the given scheduler limits
+    assert scheduler.targets.count("host:10.1.1.1") == 2
+    assert scheduler.targets.count("host:10.1.1.2") == 1
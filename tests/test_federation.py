@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from pywisp_emibcn.aircontrol import ACSession, ACFederation
+
+
+class FakeSession(ACSession):
+    '''AirControl server answering from an in-memory inventory'''
+
+    def __init__(self, name, devices):
+        super().__init__("https://" + name, "user", "password")
+        self.inventory = devices
+        self.patches = []
+
+    def login(self):
+        pass
+
+    def fetchDevices(self):
+        return [dict(dev, properties=dict(dev['properties'])) for dev in self.inventory]
+
+    def refresh(self):
+        return self.updateDevices(self.fetchDevices())
+
+    def getDevicesURL(self, list):
+        # Answered by deviceId, in the server's own order
+        return {id: "{}/{}".format(self.URL, id) for id in reversed(list)
+                if id in [dev['deviceId'] for dev in self.inventory]}
+
+    def patchDeviceList(self, patchList):
+        self.patches += patchList
+
+
+def device(id, mac, parent=None):
+    dev = {'deviceId': id, 'properties': {'hostname': mac, 'mac': mac}}
+    if parent is not None:
+        dev['parentId'] = parent
+    return dev
+
+
+def federation():
+    # Same deviceIds on both servers: 1 is the BR of 2 on each of them
+    return ACFederation({
+        'north': FakeSession("north", [device(1, "n1"), device(2, "n2", parent=1)]),
+        'south': FakeSession("south", [device(1, "s1"), device(2, "s2", parent=1),
+                                       device(3, "s3")]),
+    })
+
+
+def macs(devices):
+    return [dev['properties']['mac'] for dev in devices]
+
+
+def test_federation_keys():
+    ac = federation()
+    assert len(ac.getDevices()) == 5
+
+    topology = ac.getTopology()
+    assert macs(topology.subtree(("north", 1))) == ["n2"]
+    assert macs(topology.subtree(("south", 1))) == ["s2"]
+
+    assert ac.getDeviceById(("south", 2))['properties']['mac'] == "s2"
+    assert ac.getDeviceById(3)['properties']['mac'] == "s3"
+
+
+def test_federation_patches():
+    ac = federation()
+    ac.patchDeviceList([ac.patchDeviceCreate(("south", 2), {"parentId": 1}),
+                        ac.patchDeviceCreate(3, {"parentId": 1})])
+
+    assert ac.sessions['north'].patches == []
+    assert ac.sessions['south'].patches == [{'parentId': 1, 'deviceId': 2},
+                                            {'parentId': 1, 'deviceId': 3}]
+
+    # Bare deviceIds on several servers are ambiguous
+    try:
+        ac.patchDeviceList([ac.patchDeviceCreate(2, {"parentId": 1})])
+    except Exception as e:
+        assert "several" in str(e)
+    else:
+        raise AssertionError("Ambiguous deviceId should fail")
+
+
+def test_federation_urls():
+    ac = federation()
+    urls = ac.getDevicesURL([("south", 1), ("north", 9), ("north", 1), 8, ("south", 3)])
+    assert urls == {("south", 1): "https://south/1", ("north", 1): "https://north/1",
+                    ("south", 3): "https://south/3"}
+
+    # Devices the server doesn't answer for are left out
+    ac.sessions['south'].inventory.pop()
+    assert ac.getDevicesURL([("south", 1), ("south", 3)]) == {("south", 1): "https://south/1"}
+
+
+def test_federation_update():
+    ac = federation()
+    north = ac.getDevices()[0]
+    assert north['controller'] == "north"
+
+    ac.sessions['south'].inventory[0]['properties']['hostname'] = "changed"
+    changes = ac.refresh()
+
+    # Only the south device 1 changed, in place
+    assert [ac.deviceKey(dev) for dev in changes['modified']] == [("south", 1)]
+    assert not changes['added'] and not changes['removed']
+    assert north['properties']['hostname'] == "n1"
+    assert ac.getDevices()[0] is north
+
+
+class BrokenSession(FakeSession):
+
+    def fetchDevices(self):
+        raise Exception("Server down")
+
+
+def test_federation_errors():
+    ac = federation()
+    ac.sessions['south'] = BrokenSession("south", [])
+
+    # A partial inventory is not merged
+    try:
+        ac.getDevices()
+    except Exception as e:
+        assert "south" in str(e)
+    else:
+        raise AssertionError("Missing inventory should fail")
+    assert list(ac.errors) == ['south']
+
+    # Errors are only those of the last call
+    ac.parallel(lambda name: name, names=['north'])
+    assert ac.errors == {}
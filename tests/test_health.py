@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from pywisp_emibcn import health as health_module
+from pywisp_emibcn.health import HostHealth
+
+
+def test_failure_threshold():
+    health = HostHealth()
+    for i in range(health.threshold - 1):
+        health.failure("10.1.1.1")
+    assert not health.is_open("10.1.1.1")
+
+    health.failure("10.1.1.1")
+    assert health.is_open("10.1.1.1")
+    assert not health.is_open("10.1.1.2")
+
+    # Any success closes the circuit again
+    health.success("10.1.1.1")
+    assert not health.is_open("10.1.1.1")
+    assert health.record("10.1.1.1")['failures'] == 0
+
+
+def test_latency_average():
+    health = HostHealth()
+    health.success("10.1.1.1", 1.0)
+    assert health.record("10.1.1.1")['latency'] == 1.0
+
+    health.success("10.1.1.1", 2.0)
+    assert abs(health.record("10.1.1.1")['latency'] - (1.0 + health.alpha)) < 1e-9
+
+    # Successes without latency keep the average
+    health.success("10.1.1.1")
+    assert abs(health.record("10.1.1.1")['latency'] - (1.0 + health.alpha)) < 1e-9
+
+
+def test_timeout_bounds():
+    health = HostHealth()
+    assert health.timeout("10.1.1.1") == health.max_timeout
+
+    health.success("10.1.1.1", 0.01)
+    assert health.timeout("10.1.1.1") == health.min_timeout
+
+    health.success("10.1.1.2", 0.5)
+    assert health.timeout("10.1.1.2") == health.factor * 0.5
+
+    health.success("10.1.1.3", 60)
+    assert health.timeout("10.1.1.3") == health.max_timeout
+
+
+def test_allowed_probes_once(monkeypatch):
+    scans = []
+
+    def tcp_scan(hosts, port=22, timeout=1.0):
+        scans.append(sorted(hosts))
+        return {"10.1.1.2"}
+    monkeypatch.setattr(health_module, 'tcp_scan', tcp_scan)
+
+    health = HostHealth()
+    for i in range(health.threshold):
+        health.failure("10.1.1.2")
+        health.failure("10.1.1.3")
+
+    hosts = ["10.1.1.1", "10.1.1.2", "10.1.1.3"]
+    assert health.allowed(hosts) == {"10.1.1.1", "10.1.1.2"}
+    assert scans == [["10.1.1.2", "10.1.1.3"]]
+
+    # Retries don't probe again hosts which already answered
+    assert health.allowed(hosts) == {"10.1.1.1", "10.1.1.2"}
+    assert scans == [["10.1.1.2", "10.1.1.3"], ["10.1.1.3"]]
@@ -0,0 +1,59 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from pywisp_emibcn.aircontrol import ACSession
+
+
+def inventory():
+    return [{'deviceId': i, 'properties': {'hostname': "dev%d" % i, 'ip': i}}
+            for i in range(4)]
+
+
+def ids(devices):
+    return [dev['deviceId'] for dev in devices]
+
+
+def test_update_devices():
+    session = ACSession("https://localhost", "user", "password")
+    session.devices = inventory()
+    session.getIPIndex()
+    kept = session.devices[1]
+
+    devices = inventory()
+    devices[1]['properties']['hostname'] = "changed"
+    devices.append({'deviceId': 9, 'properties': {}})
+    del devices[0]
+
+    changes = session.updateDevices(devices)
+    assert ids(changes['added']) == [9]
+    assert ids(changes['removed']) == [0]
+    assert ids(changes['modified']) == [1]
+
+    # Modified devices are updated in place, and indexes rebuilt
+    assert kept['properties']['hostname'] == "changed"
+    assert session.devices[0] is kept
+    assert session.ip_index is None
+
+    assert session.updateDevices(devices) == {
+        'added': [], 'removed': [], 'modified': []}
+
+
+class FakeResponse():
+
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+def test_devices_url():
+    session = ACSession("https://localhost", "user", "password")
+
+    # Results are matched by their own deviceId, whatever their order
+    session.sendRequest = lambda *args, **kwargs: FakeResponse({'results': [
+        {'deviceId': 3, 'url': "https://localhost/3"},
+        {'deviceId': 1, 'url': "https://localhost/1"},
+    ]})
+    assert session.getDevicesURL([1, 2, 3]) == {
+        1: "https://localhost/1", 3: "https://localhost/3"}
@@ -0,0 +1,26 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import json
+import pytest
+
+from pywisp_emibcn.jsonstream import iter_json_array
+
+
+def test_iter_json_array():
+    document = {
+        'count': 20,
+        'results': [{'deviceId': i, 'properties': {'hostname': u"àntena-]{%d" % i}}
+                    for i in range(20)],
+        'after': [1, 2],
+    }
+    raw = json.dumps(document, indent=1, ensure_ascii=False).encode()
+
+    for size in (1, 5, 64, len(raw)):
+        chunks = (raw[i:i + size] for i in range(0, len(raw), size))
+        assert list(iter_json_array(chunks, 'results')) == document['results']
+
+    assert list(iter_json_array([b'{"results": []}'], 'results')) == []
+
+    with pytest.raises(ValueError):
+        list(iter_json_array([raw[:100]], 'results'))
@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from pywisp_emibcn.mikrotik import LeaseIndex, LeaseCache
+from pywisp_emibcn.wisp import Wisp
+
+
+def lease(n, hostname=None):
+    return {'address': "10.1.1.%d" % n, 'mac-address': "00:0C:42:00:00:%02X" % n,
+            'host-name': hostname or "host%d" % n, 'status': 'bound'}
+
+
+class FakeRouter():
+    '''Router answering DHCP leases from memory'''
+
+    def __init__(self, ip, leases=None, error=None):
+        self.ip = ip
+        self.leases = leases or []
+        self.error = error
+        self.logged_out = False
+
+    def getDHCPLeases(self, name="", bound=True):
+        if self.error is not None:
+            raise self.error
+        return [dict(lease) for lease in self.leases]
+
+    def logout(self):
+        self.logged_out = True
+
+
+def test_lease_index():
+    index = LeaseIndex()
+    index.add(FakeRouter("10.0.0.1"), [lease(1), lease(2, "shared")])
+    index.add(FakeRouter("10.0.0.2"), [lease(3, "SHARED")])
+
+    assert len(index) == 3
+    assert index.by_mac["00:0c:42:00:00:01"]['router'] == "10.0.0.1"
+    assert [l['router'] for l in index.by_hostname["shared"]] == ["10.0.0.1", "10.0.0.2"]
+
+
+def test_harvest_dhcp_leases():
+    error = Exception("Connection refused")
+    routers = [FakeRouter("10.0.0.1", [lease(1)]),
+               FakeRouter("10.0.0.2", error=error),
+               FakeRouter("10.0.0.3", [lease(3), lease(4)])]
+
+    index = Wisp().harvest_dhcp_leases(routers)
+
+    # The failing router doesn't stop the others
+    assert sorted(l['address'] for l in index.leases) == ["10.1.1.1", "10.1.1.3", "10.1.1.4"]
+    assert index.errors == {"10.0.0.2": error}
+    assert all(router.logged_out for router in routers)
+
+
+class FakeLeasesRouter(FakeRouter):
+    '''Router answering `fetchDHCPLeases`, recording its filters'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fetches = []
+
+    def fetchDHCPLeases(self, where=""):
+        self.fetches.append(where)
+        return [dict(lease) for lease in self.leases]
+
+
+def test_lease_cache():
+    now = [1000.0]
+    cache = LeaseCache(ttl=60, full_ttl=900)
+    cache.clock = lambda: now[0]
+    router = FakeLeasesRouter("10.0.0.1", [lease(1), lease(2)])
+
+    assert len(cache.get(router)) == 2
+    assert router.fetches == [""]
+
+    # Answered locally until the TTL expires
+    router.leases = [lease(3)]
+    now[0] += 30
+    assert len(cache.get(router)) == 2
+    assert router.fetches == [""]
+
+    # Expired: only leases seen since the last refresh, merged by MAC
+    now[0] += 45
+    router.leases = [lease(2, "renamed"), lease(3)]
+    leases = cache.get(router)
+    assert router.fetches == ["", " last-seen<76s"]
+    assert sorted(l['host-name'] for l in leases) == ["host1", "host3", "renamed"]
+    assert [l['address'] for l in cache.get(router, name="^ren")] == ["10.1.1.2"]
+
+    # Full refresh forgets removed leases
+    now[0] += 901
+    router.leases = [lease(3)]
+    assert [l['address'] for l in cache.get(router)] == ["10.1.1.3"]
+    assert router.fetches[-1] == ""
+
+    cache.invalidate(router)
+    cache.get(router)
+    assert router.fetches[-1] == "" and len(router.fetches) == 4
@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from pywisp_emibcn.location import LocationIndex
+from pywisp_emibcn.match import HostMatcherSet
+from pywisp_emibcn.aircontrol import ACDevice
+from pywisp_emibcn.wisp import Wisp
+
+
+class BR():
+    def __init__(self, id, controller=None):
+        self.id = id
+        self.controller = controller
+
+
+def station(n):
+    return {'mac': "00:15:6D:00:00:%02X" % n, 'lastip': "10.1.1.%d" % n,
+            'name': "client%d" % n, 'signal': -60}
+
+
+def test_location_index():
+    index = LocationIndex()
+    index.update(BR(1), [station(1), station(2)])
+    index.update(BR(2), [station(3)])
+
+    assert index.locate(HostMatcherSet("00:15:6d:00:00:02"))[0] == {(None, 1)}
+    brs, found = index.locate(HostMatcherSet(["10.1.1.1", "client3"]))
+    assert brs == {(None, 1), (None, 2)} and len(found) == 2
+    assert index.locate(HostMatcherSet("client9")) == (set(), set())
+
+    # Client moved from BR 1 to BR 2
+    index.update(BR(2), [station(3), station(2)])
+    index.update(BR(1), [station(1)])
+    assert index.locate(HostMatcherSet("client2"))[0] == {(None, 2)}
+
+
+def test_location_index_federation():
+    # Same BR deviceId on two AirControl servers
+    index = LocationIndex()
+    index.update(BR(1, "north"), [station(1)])
+    index.update(BR(1, "south"), [station(2)])
+
+    assert index.locate(HostMatcherSet("client1"))[0] == {("north", 1)}
+    assert index.locate(HostMatcherSet("client2"))[0] == {("south", 1)}
+
+
+class StationsBR(BR):
+    '''BR answering a fixed station table'''
+
+    def __init__(self, id, stations):
+        super().__init__(id)
+        self.name = "br%d" % id
+        self.stations = stations
+        self.asked = 0
+
+    def getTargets(self):
+        return []
+
+    def getWifiStations(self):
+        self.asked += 1
+        index = ACDevice.location_index
+        if index is not None:
+            index.update(self, self.stations)
+        return self.stations
+
+    def logout(self):
+        pass
+
+
+def test_deep_lookup_with_index():
+    brs = [StationsBR(1, [station(1), station(2)]), StationsBR(2, [station(3)])]
+
+    class IndexedWisp(Wisp):
+        def get_ac_brs(self, from_br=None):
+            return brs
+
+    def asked():
+        counts = [br.asked for br in brs]
+        for br in brs:
+            br.asked = 0
+        return counts
+
+    ACDevice.location_index = LocationIndex()
+    try:
+        wisp = IndexedWisp()
+        wisp.sweep_locations()
+        asked()
+
+        # Exact queries found where located: only that BR is asked
+        assert len(wisp.get_aircontrol_deep(["00:15:6d:00:00:01", "10.1.1.2"])) == 2
+        assert asked() == [1, 0]
+
+        # Other queries may match new clients anywhere
+        assert len(wisp.get_aircontrol_deep("client")) == 3
+        assert asked() == [1, 1]
+
+        # A client moved away: all BRs are asked
+        brs[1].stations.append(brs[0].stations.pop())
+        clients = wisp.get_aircontrol_deep(["10.1.1.1", "10.1.1.2"])
+        assert sorted(c['properties']['ip'] for c in clients) == ["10.1.1.1", "10.1.1.2"]
+        assert asked() == [2, 1]
+    finally:
+        ACDevice.location_index = None
+
+
+def test_location_index_reload(tmp_path):
+    index = LocationIndex(str(tmp_path / "locations.json"))
+    index.update(BR(1), [station(1), station(2)])
+    index.update(BR(2), [station(3)])
+    index.save()
+
+    # BR station tables are known again after loading
+    index = LocationIndex(str(tmp_path / "locations.json"))
+    index.update(BR(1), [station(1), station(3)])
+    assert index.locate(HostMatcherSet("client2")) == (set(), set())
+    assert index.locate(HostMatcherSet("client3"))[0] == {(None, 1)}
+
+    # Moved clients are not removed by their former BR
+    index.update(BR(2), [])
+    assert index.locate(HostMatcherSet("client3"))[0] == {(None, 1)}
@@ -0,0 +1,52 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from pywisp_emibcn.match import HostMatcherSet
+
+stations = [
+    {'mac': '24:A4:3C:00:00:01', 'lastip': '10.1.1.1',
+        'remote': {'hostname': 'Client-One'}},
+    {'mac': '24:A4:3C:00:00:02', 'lastip': '10.1.1.10',
+        'remote': {'hostname': 'client-two'}},
+    {'mac': '24:A4:3C:00:00:03', 'lastip': '10.2.0.5', 'name': 'no-remote'},
+]
+
+
+def names(matched):
+    return [s['lastip'] for s, m in matched]
+
+
+def test_match_stations():
+    assert names(HostMatcherSet("10.1.1.1").match_stations(
+        stations)) == ['10.1.1.1']
+    assert names(HostMatcherSet("10.1.0.0/16").match_stations(stations)) == [
+        '10.1.1.1', '10.1.1.10']
+    assert names(HostMatcherSet("24-a4-3c-00-00-02").match_stations(stations)) == [
+        '10.1.1.10']
+    assert names(HostMatcherSet("client*").match_stations(stations)) == [
+        '10.1.1.1', '10.1.1.10']
+    assert names(HostMatcherSet("re:^no-").match_stations(stations)) == [
+        '10.2.0.5']
+    assert names(HostMatcherSet("one").match_stations(
+        stations)) == ['10.1.1.1']
+
+    # Several queries in one pass
+    matched = HostMatcherSet(
+        ["10.2.0.5", "24:a4:3c:00:00:01"]).match_stations(stations)
+    assert names(matched) == ['10.1.1.1', '10.2.0.5']
+
+
+def test_ip_index():
+    from pywisp_emibcn.index import IPIndex
+    from pywisp_emibcn.match import parse_ip_range
+
+    devices = [{'ip': ip} for ip in (
+        parse_ip_range(i)[0] for i in ('10.1.1.10', '10.20.3.4', '10.1.1.1', '10.20.0.1'))]
+    devices.append({})
+    index = IPIndex(devices, key=lambda dev: dev.get('ip'))
+
+    assert len(index) == 4
+    assert index.lookup("10.1.1.1") == [devices[2]]
+    assert index.lookup("10.20.0.0/16") == [devices[3], devices[1]]
+    assert index.lookup("10.1.1.2-10.1.1.10") == [devices[0]]
+    assert index.lookup("10.1.") is None
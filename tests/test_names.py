@@ -0,0 +1,42 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+
+from pywisp_emibcn.sshdevice import SSHDevice
+from pywisp_emibcn.names import NameCache, resolve_names
+
+
+class NamedDevice(SSHDevice):
+    calls = 0
+
+    def getName(self):
+        NamedDevice.calls += 1
+        if self.ip == "10.0.0.3":
+            raise OSError("Unreachable")
+        self.name = "dev-" + self.ip
+
+
+def test_resolve_names():
+    file = os.path.join(tempfile.mkdtemp(), "names.json")
+
+    devices = [NamedDevice(ip="10.0.0.%d" % i) for i in range(4)]
+    errors = resolve_names(devices, cache=NameCache(file))
+    assert [device.ip for device, error in errors] == ["10.0.0.3"]
+    assert str(devices[0]) == "dev-10.0.0.0 : 10.0.0.0"
+
+    # Names are reused from the persisted cache, without asking devices
+    NamedDevice.calls = 0
+    cache = NameCache(file)
+    devices = [NamedDevice(ip="10.0.0.%d" % i) for i in range(3)]
+    assert resolve_names(devices, cache=cache) == []
+    assert NamedDevice.calls == 0
+    assert devices[2].name == "dev-10.0.0.2"
+
+    # Expired names are asked again
+    cache.ttl = 0
+    device = NamedDevice(ip="10.0.0.1")
+    device.name_cache = cache
+    assert device.name == "dev-10.0.0.1"
+    assert NamedDevice.calls == 1
@@ -0,0 +1,66 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+from pywisp_emibcn.parallel import Scheduler, parallel_map
+
+
+def test_scheduler_limits():
+    scheduler = Scheduler(workers=4, limits={'br': 2})
+    running = {}
+    peaks = {}
+    lock = threading.Lock()
+
+    def work(item):
+        br, index = item
+        with lock:
+            running[br] = running.get(br, 0) + 1
+            running['all'] = running.get('all', 0) + 1
+            for key in (br, 'all'):
+                peaks[key] = max(peaks.get(key, 0), running[key])
+        time.sleep(0.02)
+        with lock:
+            running[br] -= 1
+            running['all'] -= 1
+        if index == 3:
+            raise ValueError(index)
+        return index
+
+    items = [(br, index) for br in ('a', 'b', 'c') for index in range(5)]
+    results = parallel_map(work, items, scheduler=scheduler,
+                           targets=lambda item: ["br:" + item[0]])
+
+    assert [item for item, result, error in results] == items
+    assert [type(error) for item, result, error in results if error] == [
+        ValueError] * 3
+    assert peaks['a'] <= 2 and peaks['b'] <= 2 and peaks['c'] <= 2
+    assert peaks['all'] <= 4
+
+
+def test_scheduler_from_config():
+    scheduler = Scheduler.from_config(
+        {'workers': '8', 'limit.br': '1', 'rate.controller': '5'})
+    assert scheduler.workers == 8
+    assert scheduler.limits['br'] == 1
+    assert scheduler.limits['ccr'] == 4
+    assert scheduler.rates == {'controller': 5.0}
+
+
+def test_parallel_map_workers():
+    running = [0]
+    peak = [0]
+    lock = threading.Lock()
+
+    def work(item):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+
+    # The caller's limit holds under a scheduler allowing more
+    parallel_map(work, range(12), workers=2, scheduler=Scheduler(workers=16),
+                 targets=lambda item: [])
+    assert peak[0] <= 2
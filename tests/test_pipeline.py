@@ -0,0 +1,33 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import gzip
+import os
+import tempfile
+import pytest
+
+from pywisp_emibcn.aircontrol import ACDevice
+from pywisp_emibcn.pipeline import InvalidBackup, validate_backup, process_backup
+
+EXPORT = b"# jan/02/1970 00:00:00 by RouterOS 6.48.6\n/system identity\nset name=ccr\n"
+
+
+def test_validate_backup():
+    tar = ACDevice.tarFiles({'/tmp/system.cfg': b"users.1.name=admin\n"})
+    validate_backup(tar, 'tar')
+    validate_backup(EXPORT, 'export')
+    validate_backup(b"anything", None)
+
+    for data, format in ((b"", None), (tar[:600], 'tar'), (b"\0" * 1024, 'tar'),
+                         (EXPORT[:-1], 'export'), (b"/ip address\n", 'export')):
+        with pytest.raises(InvalidBackup):
+            validate_backup(data, format)
+
+
+def test_process_backup():
+    file = os.path.join(tempfile.mkdtemp(), "ccr.bkp.gz")
+    checksum, size = process_backup(EXPORT, file, format='export', compress=True)
+
+    assert os.stat(file).st_size == size
+    with gzip.open(file) as f:
+        assert f.read() == EXPORT
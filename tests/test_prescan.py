@@ -0,0 +1,41 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import socket
+
+from pywisp_emibcn import sshdevice
+from pywisp_emibcn.health import tcp_scan
+from pywisp_emibcn.mikrotik import MTDevice
+
+
+def test_tcp_scan():
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+    port = server.getsockname()[1]
+    try:
+        assert tcp_scan(["127.0.0.1"], port=port, timeout=1.0) == {"127.0.0.1"}
+    finally:
+        server.close()
+    assert tcp_scan(["127.0.0.1"], port=port, timeout=1.0) == set()
+
+
+def test_prescan_rescans_silent_devices(monkeypatch):
+    scans = []
+
+    def tcp_scan(hosts, port=22, timeout=1.0):
+        scans.append((list(hosts), timeout))
+        # The first SYN to 10.1.1.2 is lost, 10.1.1.3 is down
+        if len(scans) == 1:
+            return {"10.1.1.1"}
+        return {"10.1.1.2"} & set(hosts)
+
+    monkeypatch.setattr(sshdevice, 'tcp_scan', tcp_scan)
+    devices = [MTDevice({}, ip="10.1.1.%d" % i, name="dev%d" % i) for i in (1, 2, 3)]
+
+    reachable, unreachable = sshdevice.prescan_devices(devices, timeout=2.5)
+    assert [d.ip for d in reachable] == ["10.1.1.1", "10.1.1.2"]
+    assert [d.ip for d in unreachable] == ["10.1.1.3"]
+    assert unreachable[0].unreachable and not reachable[1].unreachable
+    assert scans == [(["10.1.1.1", "10.1.1.2", "10.1.1.3"], 2.5),
+                     (["10.1.1.2", "10.1.1.3"], 2.5)]
@@ -0,0 +1,37 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import tempfile
+
+from pywisp_emibcn.profiling import Profiler
+
+
+def test_profiler():
+    profiler = Profiler()
+    with profiler.phase('connect', "10.0.0.1"):
+        pass
+    assert profiler.phases == []
+
+    profiler.start()
+    for ip in ("10.0.0.1", "10.0.0.2"):
+        with profiler.phase('connect', ip):
+            pass
+        with profiler.phase('read', ip):
+            sum(range(10000 if ip == "10.0.0.2" else 10))
+    with profiler.phase('http'):
+        pass
+    profiler.stop()
+
+    assert profiler.totals()['connect'][0] == 2
+    assert [device for device, seconds, phases in profiler.slowest(1)] == ["10.0.0.2"]
+
+    prefix = os.path.join(tempfile.mkdtemp(), "profile")
+    profiler.write(prefix)
+    assert os.path.isfile(prefix + ".prof")
+    with open(prefix + ".speedscope.json") as f:
+        speedscope = json.load(f)
+    assert [frame['name'] for frame in speedscope['shared']['frames']] == [
+        'connect', 'read', 'http']
+    assert len(speedscope['profiles'][0]['events']) == 10
@@ -41,3 +41,59 @@ def test_parse_device(capsys):
     pywisp.parse_device(device[0])
     captured = capsys.readouterr()
     assert captured.out == pywisp.args.host + "\n"
+
+# Test `get_ip` output as JSON lines
+
+
+def test_parse_device_jsonl(capsys):
+    pywisp.args.format = "jsonl"
+    try:
+        pywisp.parse_device(device[0])
+    finally:
+        pywisp.args.format = "text"
+    captured = capsys.readouterr()
+    assert captured.out == '{"host":"%s","ip":"%s"}\n' % (
+        pywisp.args.host, pywisp.args.host)
+
+# Test several devices output keeps their order
+
+
+def test_parse_devices(capsys):
+    hosts = ["10.255.255.%d" % i for i in range(1, 11)]
+    assert pywisp.parse_devices(pywisp.wisp.get_host(hosts)) == []
+    captured = capsys.readouterr()
+    assert captured.out == "".join(host + "\n" for host in hosts)
+
+# Persistent caches are only set up by the command line
+
+
+def test_no_caches():
+    from pywisp_emibcn.sshdevice import SSHDevice
+    from pywisp_emibcn.aircontrol import ACDevice
+    assert SSHDevice.name_cache is None
+    assert ACDevice.location_index is None
+
+# Test WebUI URLs are matched by device, even with missing ones
+
+
+def test_parse_devices_urls(capsys):
+    class FakeAC():
+        def getDevicesURL(self, keys):
+            # Answered out of order, and without device 2
+            return {key: "https://ac/%d" % key for key in reversed(keys) if key != 2}
+
+    devices = pywisp.wisp.get_host(["10.255.255.%d" % i for i in (1, 2, 3)])
+    for key, device in enumerate(devices, 1):
+        device.key = key
+
+    pywisp.wisp.ac = FakeAC()
+    pywisp.args.url = True
+    try:
+        failed = pywisp.parse_devices(devices)
+    finally:
+        pywisp.args.url = False
+        pywisp.wisp.ac = None
+
+    assert failed == [devices[1]]
+    captured = capsys.readouterr()
+    assert captured.out == "10.255.255.1\nhttps://ac/1\n10.255.255.3\nhttps://ac/3\n"
@@ -0,0 +1,42 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from pywisp_emibcn.records import DeviceRecord
+from pywisp_emibcn.aircontrol import ACDevice, STATUS
+
+device_json = {
+    'deviceId': 42,
+    'parentId': 7,
+    'properties': {
+        'hostname': 'br-test',
+        'ip': 167772417,
+        'mac': '24:A4:3C:01:02:03',
+        'status': 2,
+        'essid': 'wisp',
+        'wlanOpModeString': 'ap',
+    }
+}
+
+
+def test_record_from_aircontrol():
+    loads = []
+
+    def loader(record):
+        loads.append(record.id)
+        return device_json
+
+    record = DeviceRecord.from_aircontrol(
+        device_json, loader=loader, status=STATUS)
+    assert not hasattr(record, '__dict__')
+    assert record.ip_address == "10.0.1.1"
+    assert record.mac_address == "24:a4:3c:01:02:03"
+    assert record.status == "online"
+    assert record.parent == 7
+    assert loads == []
+
+    device = ACDevice(record)
+    assert device.ip == "10.0.1.1"
+    assert device.branch == 7
+    assert device.data is device_json
+    assert device.data is device_json
+    assert loads == [42]
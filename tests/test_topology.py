@@ -0,0 +1,37 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from pywisp_emibcn.topology import Topology
+
+# 1 -> 2 -> (3, 4 -> 5), 6 (unknown parent), 7 <-> 8 (loop)
+devices = [
+    {'deviceId': 1},
+    {'deviceId': 2, 'parentId': 1},
+    {'deviceId': 3, 'parentId': 2},
+    {'deviceId': 4, 'parentId': 2},
+    {'deviceId': 5, 'parentId': 4},
+    {'deviceId': 6, 'parentId': 99},
+    {'deviceId': 7, 'parentId': 8},
+    {'deviceId': 8, 'parentId': 7},
+]
+
+
+def ids(devices):
+    return [dev['deviceId'] for dev in devices]
+
+
+def test_topology():
+    topology = Topology(devices)
+
+    assert ids(topology.subtree(1)) == [2, 3, 4, 5]
+    assert ids(topology.subtree(4, include_self=True)) == [4, 5]
+    assert topology.client_count(2) == 3
+    assert topology.client_count(6) == 0
+    assert ids(topology.ancestors(5)) == [4, 2, 1]
+    assert topology.is_ancestor(2, 5)
+    assert not topology.is_ancestor(3, 5)
+    assert topology.depth(5) == 3
+
+    # Loops don't hang
+    assert len(topology.order) == len(devices)
+    assert ids(topology.ancestors(7)) == [8]
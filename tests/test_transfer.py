@@ -0,0 +1,278 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import io
+import re
+import pytest
+
+from pywisp_emibcn.sshdevice import SSHDevice, push_device
+
+
+class FakeChannel():
+    '''SSH channel replaying a remote command's output, and recording what is sent to it'''
+
+    def __init__(self, output=b"", status=0):
+        self.output = io.BytesIO(output)
+        self.status = status
+        self.sent = b""
+        self.command = None
+        self.closed = False
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def exec_command(self, command):
+        self.command = command
+
+    def makefile(self, mode="rb"):
+        return self.output
+
+    def sendall(self, data):
+        self.sent += data
+
+    def recv_exit_status(self):
+        return self.status
+
+    def shutdown_write(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class FakeStream(io.BytesIO):
+    def __init__(self, data=b"", channel=None):
+        super().__init__(data)
+        self.channel = channel
+
+
+class FakeClient():
+    '''SSH client whose sessions answer with the queued channels
+
+    Commands run with `exec_command` are answered by `commands[command]`, a
+    (stdout, stderr, status) tuple. SFTP is not available.
+    '''
+
+    def __init__(self, channels=(), commands=None):
+        self.channels = list(channels)
+        self.commands = commands or {}
+        self.executed = []
+
+    def get_transport(self):
+        return self
+
+    def open_session(self, timeout=None):
+        return self.channels.pop(0)
+
+    def open_sftp(self):
+        raise IOError("No SFTP subsystem")
+
+    def exec_command(self, command, timeout=None):
+        self.executed.append(command)
+        stdout, stderr, status = self.commands.get(command, (b"", b"", 0))
+        channel = FakeChannel(status=status)
+        stdin = FakeStream(channel=channel)
+        stdin.write = lambda data: channel.sendall(data)
+        return stdin, FakeStream(stdout, channel), FakeStream(stderr, channel)
+
+    def close(self):
+        pass
+
+
+class FakeDevice(SSHDevice):
+
+    def __init__(self, client, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.client = client
+
+    def login(self):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def transfer_methods():
+    SSHDevice.transfer_methods = {}
+    yield
+    SSHDevice.transfer_methods = {}
+
+
+def test_transfer_method():
+    client = FakeClient(commands={'command -v scp': (b"/usr/bin/scp\n", b"", 0)})
+    device = FakeDevice(client, ip="10.1.1.1", name="ap")
+    assert device.getTransferMethod() == 'scp'
+
+    # Detected once per IP
+    assert device.getTransferMethod() == 'scp'
+    assert client.executed == ['command -v scp']
+
+    device = FakeDevice(FakeClient(), ip="10.1.1.2", name="old")
+    assert device.getTransferMethod() == 'exec'
+
+
+def test_scp_receive():
+    channel = FakeChannel(
+        b"C0644 6 system.cfg\nabcdef\0"
+        b"\x01scp: /etc/persistent/rc.prestart: No such file or directory\n"
+        b"C0600 3 rc.poststart\nxyz\0")
+    device = FakeDevice(FakeClient([channel]), ip="10.1.1.1", name="ap")
+
+    files = device.scpReceive(["/tmp/system.cfg", "/etc/persistent/rc.prestart",
+                               "/etc/persistent/rc.poststart"])
+    assert files == {"/tmp/system.cfg": b"abcdef", "/etc/persistent/rc.poststart": b"xyz"}
+    assert channel.command == 'scp -f "/tmp/system.cfg" "/etc/persistent/rc.prestart" ' \
+                              '"/etc/persistent/rc.poststart"'
+    # Ready, and then ready and received for every file
+    assert channel.sent == b"\0" * 5
+    assert channel.closed
+
+
+def test_scp_receive_fatal():
+    channel = FakeChannel(b"\x02scp: protocol error\nC0644 3 system.cfg\nabc\0")
+    device = FakeDevice(FakeClient([channel]), ip="10.1.1.1", name="ap")
+    with pytest.raises(Exception, match="protocol error"):
+        device.scpReceive(["/tmp/system.cfg"])
+
+    # Files which exist but can't be read are errors too
+    channel = FakeChannel(b"\x01scp: /tmp/system.cfg: Permission denied\n")
+    device = FakeDevice(FakeClient([channel]), ip="10.1.1.1", name="ap")
+    with pytest.raises(Exception, match="Permission denied"):
+        device.scpReceive(["/tmp/system.cfg"])
+
+    channel = FakeChannel(b"garbage\n")
+    device = FakeDevice(FakeClient([channel]), ip="10.1.1.1", name="ap")
+    with pytest.raises(Exception, match="Unexpected SCP response"):
+        device.scpReceive(["/tmp/system.cfg"])
+    assert channel.closed
+
+
+def test_scp_send():
+    channel = FakeChannel(b"\0\0\0")
+    device = FakeDevice(FakeClient([channel]), ip="10.1.1.1", name="ap")
+
+    device.scpSend("/etc/persistent/rc.poststart", b"#!/bin/sh\n", mode=0o755)
+    assert channel.command == 'scp -t "/etc/persistent/rc.poststart"'
+    assert channel.sent == b"C0755 10 rc.poststart\n#!/bin/sh\n\0"
+    assert channel.closed
+
+
+def test_scp_send_error():
+    channel = FakeChannel(b"\0\x01scp: /etc/persistent/rc.poststart: Read-only file system\n")
+    device = FakeDevice(FakeClient([channel]), ip="10.1.1.1", name="ap")
+
+    with pytest.raises(Exception, match="Read-only file system"):
+        device.scpSend("/etc/persistent/rc.poststart", b"data")
+    # Nothing sent after the refused header
+    assert channel.sent == b"C0644 4 rc.poststart\n"
+    assert channel.closed
+
+
+class FakeFilesClient(FakeClient):
+    '''SSH client of a device without SFTP nor SCP, emulating its files
+
+    With `corrupt`, uploads lose their last byte.
+    '''
+
+    def __init__(self, files=None, commands=None, corrupt=False):
+        super().__init__(commands=commands)
+        self.files = dict(files or {})
+        self.corrupt = corrupt
+
+    def exec_command(self, command, timeout=None):
+        match = re.match(r'^cat > "(.+)" && chmod \d+ "\1"$', command)
+        if match:
+            path = match.group(1)
+            self.files[path] = b""
+            stdin, stdout, stderr = super().exec_command(command, timeout)
+
+            def write(data):
+                self.files[path] += data[:-1] if self.corrupt else data
+            stdin.write = write
+            return stdin, stdout, stderr
+
+        match = re.match(r'^cat "(.+)"$', command)
+        if match:
+            path = match.group(1)
+            self.commands[command] = (self.files[path], b"", 0) if path in self.files \
+                else (b"", b"No such file or directory", 1)
+
+        match = re.match(r'^rm -f "(.+)"$', command)
+        if match:
+            self.files.pop(match.group(1), None)
+
+        return super().exec_command(command, timeout)
+
+
+def test_put_file():
+    client = FakeFilesClient()
+    device = FakeDevice(client, ip="10.1.1.1", name="ap")
+    device.putFile("/etc/persistent/rc.poststart", b"#!/bin/sh\n", mode=0o755)
+
+    assert client.files == {"/etc/persistent/rc.poststart": b"#!/bin/sh\n"}
+    assert 'cat > "/etc/persistent/rc.poststart" && chmod 755 "/etc/persistent/rc.poststart"' \
+        in client.executed
+
+
+def test_push_device():
+    client = FakeFilesClient(commands={'cfgmtd -w': (b"", b"", 0)})
+    device = FakeDevice(client, ip="10.1.1.1", name="ap")
+    push_device(device, path="/etc/persistent/rc.poststart", data=b"new", script='cfgmtd -w')
+
+    assert client.files == {"/etc/persistent/rc.poststart": b"new"}
+    assert client.executed[-1] == 'cfgmtd -w'
+
+
+def test_push_device_rollback():
+    # Failing script: the previous file is restored
+    client = FakeFilesClient(files={"/etc/rc": b"old"},
+                             commands={'reload': (b"", b"Syntax error", 1)})
+    device = FakeDevice(client, ip="10.1.1.1", name="ap")
+    with pytest.raises(Exception, match="Script failed: Syntax error"):
+        push_device(device, path="/etc/rc", data=b"new", script='reload')
+    assert client.files == {"/etc/rc": b"old"}
+
+    # Bad checksum of a new file: it is removed
+    client = FakeFilesClient(corrupt=True)
+    device = FakeDevice(client, ip="10.1.1.2", name="ap")
+    with pytest.raises(Exception, match="Checksum mismatch"):
+        push_device(device, path="/etc/rc", data=b"new")
+    assert client.files == {}
+
+    # Custom rollback
+    calls = []
+    client = FakeFilesClient(commands={'reload': (b"", b"", 1)})
+    device = FakeDevice(client, ip="10.1.1.3", name="ap")
+    with pytest.raises(Exception):
+        push_device(device, path="/etc/rc", data=b"new", script='reload',
+                    rollback=lambda *args: calls.append(args))
+    assert [call[:3] for call in calls] == [(device, "/etc/rc", None)]
+    assert client.files == {"/etc/rc": b"new"}
+
+
+def test_exec_receive_errors():
+    client = FakeClient(commands={
+        'cat "/etc/rc"': (b"rc", b"", 0),
+        'cat "/etc/missing"': (b"", b"cat: can't open '/etc/missing': No such file or directory", 1),
+        'cat "/etc/shadow"': (b"", b"cat: can't open '/etc/shadow': Permission denied", 1),
+    })
+    device = FakeDevice(client, ip="10.1.1.1", name="ap")
+    assert device.getFiles(["/etc/rc", "/etc/missing"]) == {"/etc/rc": b"rc"}
+    with pytest.raises(Exception, match="Reading /etc/shadow failed: .*Permission denied"):
+        device.getFiles(["/etc/shadow"])
+
+
+class UnreadableDevice(FakeDevice):
+
+    def getFiles(self, files):
+        raise IOError("Connection lost")
+
+
+def test_push_device_unreadable():
+    # Previous file can't be read: nothing is uploaded nor rolled back
+    calls = []
+    client = FakeFilesClient(files={"/etc/rc": b"old"})
+    device = UnreadableDevice(client, ip="10.1.1.1", name="ap")
+    with pytest.raises(IOError, match="Connection lost"):
+        push_device(device, path="/etc/rc", data=b"new",
+                    rollback=lambda *args: calls.append(args))
+    assert calls == []
+    assert client.files == {"/etc/rc": b"old"}